@@ -0,0 +1,87 @@
+#%%
+import os, pickle, shutil
+
+from joblib import Parallel, delayed
+
+class CheckpointStore():
+    # Checkpoints of a long-running pass over a BAM, kept as pickles in "path_dir"
+    # Every checkpoint is written to a temporary file and renamed, so a crash leaves either the old or the new checkpoint.
+    # Checkpoints made for another input (different size or modification time) or other parameters are discarded.
+    #   dict_params: Parameters which change the intermediate state (e.g. duplicate mode)
+    def __init__(self, path_dir, path_input, dict_params = None):
+        self.path_dir = path_dir
+        self.fingerprint = get_file_fingerprint(path_input)
+        self.fingerprint["params"] = dict_params if dict_params != None else dict()
+
+        os.makedirs(path_dir, exist_ok = True)
+        path_fingerprint = self.get_path("fingerprint")
+        if os.path.exists(path_fingerprint) and load_pickle(path_fingerprint) != self.fingerprint:
+            print(f"Discarding checkpoints of another input or parameters in {path_dir}", flush = True)
+            self.clear()
+            os.makedirs(path_dir, exist_ok = True)
+        save_pickle_atomic(path_fingerprint, self.fingerprint)
+
+    def get_path(self, key):
+        # Also used for spilled intermediate state of the pass (e.g. "scan.segment0")
+        return os.path.join(self.path_dir, f"{key}.pkl")
+
+    def has(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def save(self, key, state):
+        save_pickle_atomic(self.get_path(key), state)
+
+    def load(self, key, default = None):
+        if not self.has(key):
+            return default
+        return load_pickle(self.get_path(key))
+
+    def remove(self, key):
+        if self.has(key):
+            os.remove(self.get_path(key))
+
+    def clear(self):
+        # Remove all checkpoints, after the pass is completed
+        shutil.rmtree(self.path_dir, ignore_errors = True)
+
+def get_file_fingerprint(path_file):
+    stat_file = os.stat(path_file)
+    return {"path":os.path.realpath(path_file), "size":stat_file.st_size, "mtime_ns":stat_file.st_mtime_ns}
+
+def save_pickle_atomic(path_save, obj):
+    path_tmp = f"{path_save}.__tmp.{os.getpid()}"
+    with open(path_tmp, "wb") as file_writer:
+        pickle.dump(obj, file_writer, protocol = pickle.HIGHEST_PROTOCOL)
+        file_writer.flush()
+        os.fsync(file_writer.fileno())
+    os.replace(path_tmp, path_save)
+
+def load_pickle(path_file):
+    with open(path_file, "rb") as file_reader:
+        return pickle.load(file_reader)
+
+def run_shards_with_checkpoint(func, list_shard_args, checkpoint_store = None, parallel = 1, key_prefix = "shard"):
+    # Call func(*args) for every shard with joblib, and return the results in the order of shards
+    # With checkpoint_store, the result of each shard is saved as soon as it finishes, and finished shards are not run again.
+    list_results = [None] * len(list_shard_args)
+    list_ind_to_run = list()
+    for ind in range(len(list_shard_args)):
+        if checkpoint_store != None and checkpoint_store.has(f"{key_prefix}{ind}"):
+            list_results[ind] = checkpoint_store.load(f"{key_prefix}{ind}")
+        else:
+            list_ind_to_run.append(ind)
+    if len(list_ind_to_run) < len(list_shard_args):
+        print(f"Reusing {len(list_shard_args) - len(list_ind_to_run)} finished shards from checkpoints", flush = True)
+    if len(list_ind_to_run) == 0:
+        return list_results
+
+    with Parallel(n_jobs = min(parallel, len(list_ind_to_run)), return_as = "generator_unordered") as parallel_runner:
+        for ind, result in parallel_runner(delayed(run_indexed_shard)(ind, func, list_shard_args[ind]) for ind in list_ind_to_run):
+            if checkpoint_store != None:
+                checkpoint_store.save(f"{key_prefix}{ind}", result)
+            list_results[ind] = result
+    return list_results
+
+def run_indexed_shard(ind, func, args):
+    # Results of "generator_unordered" come in the order of finish, so they are returned with the index of shard
+    return ind, func(*args)
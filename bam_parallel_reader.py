@@ -1,9 +1,11 @@
 #%%
 from pathlib import Path
-import sys
+import sys, copy, contextlib
 
 sys.path.append(str(Path(__file__).parents[0]))
 from bam_util import *
+from bam_read_filter import *
+from bam_stats import *
 
 
 _bgzf_magic = b"\x1f\x8b\x08\x04"
@@ -44,10 +46,18 @@ def validate_bgzip_block_header(data):
 
 class BAMParallelReader():
     # Split BGzipped BAM for parallelization
-    def __init__(self, path_file, parallel = 1, path_gzi = None):
+    def __init__(self, path_file, parallel = 1, path_gzi = None, read_filter = None, progress_callback = None, progress_interval = 10):
         self.path = path_file
         self.path_gzi = path_gzi
         self.parallel = parallel
+        # BamReadFilter object. Each split reader gets its own copy, so the filter stats are counted per reader
+        self.read_filter = read_filter
+        # Called in this process with the merged stats of split readers at most once every "progress_interval" seconds,
+        # while the readers are consumed in report_progress() (also in other processes, e.g. joblib)
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        
+        self.stats = dict()
         
         self.file_handler = None
         
@@ -65,12 +75,15 @@ class BAMParallelReader():
     
     def split_bgzip_bam_into_multiple_readers(self):
         # Search for offsets to split the BGzipped BAM into multiple portions
+        time_start = perf_counter()
         self.__set_file_reader()
         self.__skip_header()
         self.__check_file_start_end_offset()
         self.__split_bam_offset_for_parallelization()
         self.__generate_blockgzipbamreaders_for_parallelizing()
-        print(self.__offsets_for_parallelizing)
+        self.stats["time_split"] = perf_counter() - time_start
+        self.stats["offsets_for_parallelizing"] = list(self.__offsets_for_parallelizing)
+        self.stats["bytes_per_shard"] = list(map(lambda bstart, bend: bend - bstart, self.__list_reader_offset_start, self.__list_reader_offset_end))
         
     def __set_file_reader(self):
         # Open BGzipped BAM file
@@ -139,7 +152,40 @@ class BAMParallelReader():
         # Each object starts reading BAM from each split offsets and ends reading BAM until the file ends, or meet the next start offset
         self.__list_reader_offset_start = self.__offsets_for_parallelizing
         self.__list_reader_offset_end = self.__offsets_for_parallelizing[1:] + [self.__offset_eof]
-        self.list_splitted_bam_reader = list(map(lambda bstart, bend: BamPartReader(self.path, bstart, bend), self.__list_reader_offset_start, self.__list_reader_offset_end))        
+        self.list_splitted_bam_reader = list(map(lambda bstart, bend: BamPartReader(self.path, bstart, bend, copy.deepcopy(self.read_filter)), self.__list_reader_offset_start, self.__list_reader_offset_end))        
+    
+    @contextlib.contextmanager
+    def report_progress(self):
+        # Consume the split readers in this context to report progress with progress_callback
+        # Each reader sends its stats to this process, where they are merged (see bam_stats.ProgressAggregator)
+        if self.progress_callback == None:
+            yield
+            return
+        progress_aggregator = ProgressAggregator(self.progress_callback, self.progress_interval)
+        progress_aggregator.start()
+        for ind, bam_reader in enumerate(self.list_splitted_bam_reader):
+            bam_reader.set_progress_callback(progress_aggregator.get_sender(ind), self.progress_interval)
+        try:
+            yield
+        finally:
+            for bam_reader in self.list_splitted_bam_reader:
+                bam_reader.set_progress_callback(None)
+            progress_aggregator.stop()
+    
+    def get_read_filter_stats(self, list_filter_stats = None):
+        # Merge the read filter stats of split readers
+        # If the readers were consumed in other processes (e.g. joblib), pass the stats returned from the workers
+        if list_filter_stats == None:
+            list_filter_stats = [bam_reader.read_filter.get_filter_stats() for bam_reader in self.list_splitted_bam_reader if bam_reader.read_filter != None]
+        return merge_read_filter_stats(list_filter_stats)
+    
+    def collect_stats(self, list_shard_stats = None):
+        # Aggregate the stats of split readers into "self.stats['shards']"
+        # If the readers were consumed in other processes (e.g. joblib), pass the stats returned from the workers
+        if list_shard_stats == None:
+            list_shard_stats = [bam_reader.stats for bam_reader in self.list_splitted_bam_reader]
+        self.stats["shards"] = merge_stats(list_shard_stats)
+        return self.stats
     
     def __close_reader(self): 
         # Close the BgzfReader for checking Block Information. If it's already closed, don't do anything
@@ -155,12 +201,23 @@ class BAMParallelReader():
         del self.file_handler
         
 class BamPartReader():
-    def __init__(self, path_file, block_start = None, block_end = None):
+    def __init__(self, path_file, block_start = None, block_end = None, read_filter = None, progress_callback = None, progress_interval = 10):
         self.path = path_file
         self.bstart = block_start
         self.bend = block_end
         assert self.bstart <= self.bend, "File reading start offset must be smaller than end offset"
         
+        # BamReadFilter object. Reads are filtered on the decompressed block before they are sliced
+        self.read_filter = read_filter
+        
+        # Counters of this reader (see bam_stats). Cheap enough to be always collected.
+        self.stats = new_stats()
+        self.stats["offset_start"] = self.bstart
+        self.stats["offset_end"] = self.bend
+        self.stats["offset_current"] = self.bstart
+        self.__time_start = None
+        self.__progress_reporter = ProgressReporter(progress_callback, progress_interval)
+        
         self.file_handler = None
         
         self.__curr_block = None
@@ -168,10 +225,15 @@ class BamPartReader():
         
         self.generator_reads = None
         
+    def set_progress_callback(self, progress_callback, progress_interval = 10):
+        # Called with the stats of this reader at most once every "progress_interval" seconds
+        self.__progress_reporter = ProgressReporter(progress_callback, progress_interval)
+
     def set_file_handler(self):
         self.file_handler = open(self.path, "rb")
         self.file_handler.seek(self.bstart)
         self.generator_reads = self.__generate_nextread_binary()
+        self.__time_start = perf_counter()
         
     def __iter__(self):
         return self
@@ -183,10 +245,22 @@ class BamPartReader():
         while 1:
             self.__read_block()
             if self.__curr_block:
-                self.__curr_reads = split_bgzf_block_into_reads(self.__curr_block)
+                time_parse_start = perf_counter()
+                if self.read_filter != None:
+                    self.__curr_reads = self.read_filter.filter_reads_of_block(self.__curr_block)
+                else:
+                    self.__curr_reads = split_bgzf_block_into_reads(self.__curr_block)
+                time_parse_end = perf_counter()
+                self.stats["time_parse"] += time_parse_end - time_parse_start
+                self.stats["reads_emitted"] += len(self.__curr_reads)
+                self.stats["offset_current"] = self.file_handler.tell()
+                self.stats["time_elapsed"] = time_parse_end - self.__time_start
+                self.__progress_reporter.report(self.stats)
                 for single_binaryread in self.__curr_reads:
                     yield single_binaryread
             else:
+                self.stats["time_elapsed"] = perf_counter() - self.__time_start
+                self.__progress_reporter.report(self.stats, force = True)
                 break
     
     def get_nextread_binary(self):
@@ -197,7 +271,7 @@ class BamPartReader():
         if curr_offset >= self.bend:
             self.__curr_block = None
         else:
-            bsize, self.__curr_block = load_bgzf_block(self.file_handler)
+            bsize, self.__curr_block = load_bgzf_block(self.file_handler, stats = self.stats)
     
     def __close_reader(self):
         if hasattr(self.file_handler, "close"):
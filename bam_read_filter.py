@@ -0,0 +1,126 @@
+#%%
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+
+# Fixed part of the BAM read record, including the leading "block_size"
+_bam_read_header_dtype = np.dtype([
+    ("block_size", "<u4"),
+    ("refID", "<i4"),
+    ("pos", "<i4"),
+    ("l_read_name", "u1"),
+    ("mapq", "u1"),
+    ("bin", "<u2"),
+    ("n_cigar_op", "<u2"),
+    ("flag", "<u2"),
+    ("l_seq", "<u4"),
+    ("next_refID", "<i4"),
+    ("next_pos", "<i4"),
+    ("tlen", "<i4"),
+])
+_bam_read_filter_clauses = ["flag_include", "flag_exclude", "min_mapq", "refID", "pos_range"]
+
+class BamReadFilter():
+    # Declarative read filter evaluated on the fixed 36 bytes of the records in the decompressed block
+    # Reads removed by the filter are never sliced nor decoded
+    #   flag_include: Keep reads having all of these flag bits (samtools view -f)
+    #   flag_exclude: Remove reads having any of these flag bits (samtools view -F)
+    #   min_mapq: Keep reads with MAPQ >= min_mapq
+    #   list_refID: Keep reads mapped on these refIDs
+    #   pos_start, pos_end: Keep reads whose 0-based leftmost position is in [pos_start, pos_end)
+    def __init__(self, flag_include = 0, flag_exclude = 0, min_mapq = 0, list_refID = None, pos_start = None, pos_end = None):
+        self.flag_include = flag_include
+        self.flag_exclude = flag_exclude
+        self.min_mapq = min_mapq
+        self.list_refID = list_refID
+        self.pos_start = pos_start
+        self.pos_end = pos_end
+
+        self.n_reads_checked = 0
+        self.n_reads_passed = 0
+        # Each read is counted only by the first clause which removed it, in the order of _bam_read_filter_clauses
+        self.dict_n_removed = dict.fromkeys(_bam_read_filter_clauses, 0)
+
+    def filter_reads_of_block(self, block_data):
+        list_read_start_bytes = get_read_start_bytes_of_block_data(block_data)
+        if len(list_read_start_bytes) == 0:
+            return list()
+        read_headers = get_read_headers_of_block_data(block_data, list_read_start_bytes)
+        is_pass = self.get_mask_of_passed_reads(read_headers)
+
+        list_reads_data = list()
+        for start_bytes, block_size in zip(list_read_start_bytes[is_pass].tolist(), read_headers["block_size"][is_pass].tolist()):
+            list_reads_data.append(block_data[start_bytes+4:start_bytes+4+block_size])
+        return list_reads_data
+
+    def get_mask_of_passed_reads(self, read_headers):
+        is_pass = np.ones(len(read_headers), dtype = bool)
+        for clause in _bam_read_filter_clauses:
+            is_pass_clause = self.__get_mask_of_clause(clause, read_headers)
+            if is_pass_clause is None:
+                continue
+            self.dict_n_removed[clause] += int(np.count_nonzero(is_pass & ~is_pass_clause))
+            is_pass &= is_pass_clause
+
+        self.n_reads_checked += len(read_headers)
+        self.n_reads_passed += int(np.count_nonzero(is_pass))
+        return is_pass
+
+    def __get_mask_of_clause(self, clause, read_headers):
+        # Returns None if the clause is not used
+        if clause == "flag_include" and self.flag_include:
+            return (read_headers["flag"] & self.flag_include) == self.flag_include
+        elif clause == "flag_exclude" and self.flag_exclude:
+            return (read_headers["flag"] & self.flag_exclude) == 0
+        elif clause == "min_mapq" and self.min_mapq:
+            return read_headers["mapq"] >= self.min_mapq
+        elif clause == "refID" and self.list_refID != None:
+            return np.isin(read_headers["refID"], list(self.list_refID))
+        elif clause == "pos_range" and (self.pos_start != None or self.pos_end != None):
+            is_pass_clause = np.ones(len(read_headers), dtype = bool)
+            if self.pos_start != None:
+                is_pass_clause &= read_headers["pos"] >= self.pos_start
+            if self.pos_end != None:
+                is_pass_clause &= read_headers["pos"] < self.pos_end
+            return is_pass_clause
+        return None
+
+    def get_filter_stats(self):
+        return {
+            "n_reads_checked" : self.n_reads_checked,
+            "n_reads_passed" : self.n_reads_passed,
+            "n_reads_removed" : dict(self.dict_n_removed)
+        }
+
+def merge_read_filter_stats(list_filter_stats):
+    # Sum up the filter stats of the split readers (e.g. returned from parallel workers)
+    dict_merged = {
+        "n_reads_checked" : 0,
+        "n_reads_passed" : 0,
+        "n_reads_removed" : dict.fromkeys(_bam_read_filter_clauses, 0)
+    }
+    for filter_stats in list_filter_stats:
+        dict_merged["n_reads_checked"] += filter_stats["n_reads_checked"]
+        dict_merged["n_reads_passed"] += filter_stats["n_reads_passed"]
+        for clause, n_removed in filter_stats["n_reads_removed"].items():
+            dict_merged["n_reads_removed"][clause] += n_removed
+    return dict_merged
+
+def get_read_start_bytes_of_block_data(block_data):
+    # Start bytes (position of "block_size") of the reads in the decompressed block
+    list_read_start_bytes = list()
+    ind_check = 0
+    len_block_data = len(block_data)
+    while ind_check < len_block_data:
+        list_read_start_bytes.append(ind_check)
+        ind_check += 4 + struct.unpack_from("<I", block_data, ind_check)[0]
+    return np.array(list_read_start_bytes, dtype = np.int64)
+
+def get_read_headers_of_block_data(block_data, list_read_start_bytes):
+    # Gather the fixed part of every read at once and view it as a structured array
+    arr_block_data = np.frombuffer(block_data, dtype = np.uint8)
+    ind_header_bytes = list_read_start_bytes[:, None] + np.arange(_bam_read_header_dtype.itemsize)
+    arr_read_headers = np.ascontiguousarray(arr_block_data[ind_header_bytes])
+    return arr_read_headers.view(_bam_read_header_dtype).reshape(-1)
@@ -0,0 +1,216 @@
+#%%
+from pathlib import Path
+import os, sys, itertools
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_region_query import *
+from bam_stats import *
+
+_record_index_magic = b"RCI\x01"
+_no_record_start = 0xFFFFFFFF # No record starts in the block
+
+def get_record_index_path(path_bam):
+    # Kept beside the BAM (and its ".gzi")
+    return f"{path_bam}.rci"
+
+class BamRecordIndex():
+    # Per-block record counts of BAM, for seeking to the N-th record (0-based) without reading from the start
+    # For each BGZF block: offset of block, number of records before the block, records starting in the block
+    # and the in-block offset of the first record starting in the block.
+    # Records spanning multiple blocks are counted in the block where they start.
+    def __init__(self):
+        self.array_coffsets = np.zeros(0, dtype = np.uint64)
+        self.array_n_records_before = np.zeros(0, dtype = np.uint64)
+        self.array_n_records = np.zeros(0, dtype = np.uint32)
+        self.array_first_record_offsets = np.zeros(0, dtype = np.uint32)
+        self.n_records = 0
+        # Number of records until the end of each block, for searching the block of a record (not saved)
+        self.array_n_records_until_end = np.zeros(0, dtype = np.uint64)
+
+    def build(self, path_bam, stats = None):
+        # Single pass over all blocks. Only the "block_size" of records are read.
+        list_coffsets = list()
+        list_n_records = list()
+        list_first_record_offsets = list()
+        with open(path_bam, "rb") as file_reader:
+            voffset_first_read = get_virtual_offset_after_header(file_reader)
+            coffset_first_read, within_first_read = split_virtual_offset(voffset_first_read)
+
+            coffset = 0
+            # Bytes left of the record started in the previous blocks, and a "block_size" split between blocks
+            n_bytes_to_skip = 0
+            block_size_data = b''
+            while 1:
+                block_data, coffset_next = read_block_data_and_size_from_offset(file_reader, coffset, stats = stats)
+                if len(block_data) == 0:
+                    break
+                if coffset < coffset_first_read:
+                    ind = len(block_data)
+                elif coffset == coffset_first_read:
+                    ind = within_first_read
+                else:
+                    ind = 0
+                n_records = 0
+                first_record_offset = _no_record_start
+                while ind < len(block_data):
+                    if len(block_size_data) > 0:
+                        n_bytes_rest = 4 - len(block_size_data)
+                        block_size_data += block_data[ind:ind+n_bytes_rest]
+                        ind += n_bytes_rest
+                        if len(block_size_data) < 4:
+                            continue
+                        n_bytes_to_skip = struct.unpack("<I", block_size_data)[0]
+                        block_size_data = b''
+                    if n_bytes_to_skip > 0:
+                        n_bytes_skipped = min(n_bytes_to_skip, len(block_data) - ind)
+                        ind += n_bytes_skipped
+                        n_bytes_to_skip -= n_bytes_skipped
+                        continue
+                    # A record starts here
+                    n_records += 1
+                    if first_record_offset == _no_record_start:
+                        first_record_offset = ind
+                    if len(block_data) - ind < 4:
+                        block_size_data = block_data[ind:]
+                        ind = len(block_data)
+                        continue
+                    n_bytes_to_skip = struct.unpack_from("<I", block_data, ind)[0]
+                    ind += 4
+                list_coffsets.append(coffset)
+                list_n_records.append(n_records)
+                list_first_record_offsets.append(first_record_offset)
+                coffset = coffset_next
+            assert n_bytes_to_skip == 0 and len(block_size_data) == 0, f"{path_bam} ends in the middle of a record"
+
+        self.array_coffsets = np.array(list_coffsets, dtype = np.uint64)
+        self.array_n_records = np.array(list_n_records, dtype = np.uint32)
+        self.array_n_records_before = np.concatenate([[0], np.cumsum(self.array_n_records, dtype = np.uint64)[:-1]]).astype(np.uint64) if len(list_n_records) > 0 else np.zeros(0, dtype = np.uint64)
+        self.array_first_record_offsets = np.array(list_first_record_offsets, dtype = np.uint32)
+        self.n_records = int(self.array_n_records.sum(dtype = np.uint64))
+        self.array_n_records_until_end = self.array_n_records_before + self.array_n_records
+        return self
+
+    def save(self, path_index):
+        # RCI magic, number of blocks, number of records, then arrays of coffsets (uint64), records before block (uint64),
+        # records starting in block (uint32) and first record offset in block (uint32)
+        with open(path_index, "wb") as handle:
+            handle.write(_record_index_magic)
+            handle.write(struct.pack("<QQ", len(self.array_coffsets), self.n_records))
+            for array_values in [self.array_coffsets, self.array_n_records_before, self.array_n_records, self.array_first_record_offsets]:
+                handle.write(array_values.astype(array_values.dtype.newbyteorder('<')).tobytes())
+
+    def load(self, path_index):
+        with open(path_index, "rb") as handle:
+            contents = handle.read()
+        assert contents[:4] == _record_index_magic, "File is not a record count index"
+        n_blocks, self.n_records = struct.unpack_from("<QQ", contents, 4)
+        ind = 20
+        list_arrays = list()
+        for dtype in ["<u8", "<u8", "<u4", "<u4"]:
+            array_values = np.frombuffer(contents, dtype = dtype, count = n_blocks, offset = ind)
+            list_arrays.append(array_values.astype(dtype[1:]))
+            ind += array_values.nbytes
+        self.array_coffsets, self.array_n_records_before, self.array_n_records, self.array_first_record_offsets = list_arrays
+        self.array_n_records_until_end = self.array_n_records_before + self.array_n_records
+        return self
+
+    def get_block_of_record(self, n):
+        # Index of the block where the n-th record starts
+        assert 0 <= n < self.n_records, f"Record {n} is out of range (total {self.n_records} records)"
+        return int(np.searchsorted(self.array_n_records_until_end, n, side = "right"))
+
+    def get_virtual_offset_of_record(self, file_handler, n):
+        # Virtual offset of the n-th record. Only the block where the record starts is read.
+        if n == self.n_records:
+            return None
+        ind_block = self.get_block_of_record(n)
+        voffset_first_record = make_virtual_offset_from_bytes(int(self.array_coffsets[ind_block])) | int(self.array_first_record_offsets[ind_block])
+        n_records_to_skip = n - int(self.array_n_records_before[ind_block])
+        for voffset, _ in itertools.islice(generate_reads_from_virtual_offset(file_handler, voffset_first_record), n_records_to_skip, n_records_to_skip+1):
+            return voffset
+
+    def generate_records(self, file_handler, n_start, n_end = None, cache = None, stats = None):
+        # Yield records [n_start, n_end) without "block_size"
+        n_end = self.n_records if n_end == None else min(n_end, self.n_records)
+        if n_start >= n_end:
+            return
+        voffset_start = self.get_virtual_offset_of_record(file_handler, n_start)
+        for _, read_data in itertools.islice(generate_reads_from_virtual_offset(file_handler, voffset_start, cache = cache, stats = stats), n_end - n_start):
+            yield read_data
+
+    def get_count_balanced_shards(self, n_shards):
+        # [n_start, n_end) of records for each shard, differing by at most one record
+        list_boundaries = [self.n_records * ind // n_shards for ind in range(n_shards+1)]
+        return [(n_start, n_end) for n_start, n_end in zip(list_boundaries[:-1], list_boundaries[1:]) if n_start < n_end]
+
+    def get_count_balanced_readers(self, path_bam, n_shards):
+        # BamRecordRangeReader of each count-balanced shard, to be consumed in workers (e.g. joblib)
+        # The start of each shard is found here, so the readers do not carry the index.
+        list_readers = list()
+        with open(path_bam, "rb") as file_reader:
+            for n_start, n_end in self.get_count_balanced_shards(n_shards):
+                list_readers.append(BamRecordRangeReader(path_bam, self.get_virtual_offset_of_record(file_reader, n_start), n_end - n_start))
+        return list_readers
+
+    def get_subsampled_blocks(self, fraction, seed = None):
+        # Indices of randomly chosen blocks among the blocks with records
+        array_ind_blocks = np.flatnonzero(self.array_n_records > 0)
+        rng = np.random.default_rng(seed)
+        return array_ind_blocks[rng.random(len(array_ind_blocks)) < fraction]
+
+    def generate_subsampled_records(self, file_handler, fraction, seed = None, cache = None, stats = None):
+        # Records starting in the randomly chosen blocks. Records are not sampled independently,
+        # but every block is chosen with the same probability, so the expected fraction of records is "fraction".
+        for ind_block in self.get_subsampled_blocks(fraction, seed):
+            voffset_first_record = make_virtual_offset_from_bytes(int(self.array_coffsets[ind_block])) | int(self.array_first_record_offsets[ind_block])
+            for _, read_data in itertools.islice(generate_reads_from_virtual_offset(file_handler, voffset_first_record, cache = cache, stats = stats), int(self.array_n_records[ind_block])):
+                yield read_data
+
+def load_or_build_record_index(path_bam, path_index = None):
+    # Build the index in a single pass if it does not exist (or is older than the BAM), and save it
+    if path_index == None:
+        path_index = get_record_index_path(path_bam)
+    if os.path.exists(path_index) and os.path.getmtime(path_index) >= os.path.getmtime(path_bam):
+        return BamRecordIndex().load(path_index)
+    record_index = BamRecordIndex().build(path_bam)
+    record_index.save(path_index)
+    return record_index
+
+class BamRecordRangeReader():
+    # Iterate "n_records" records (without "block_size") from a virtual offset, like BamPartReader for a range of records
+    # Records spanning multiple blocks are supported.
+    def __init__(self, path_file, voffset_start, n_records):
+        self.path = path_file
+        self.voffset_start = voffset_start
+        self.n_records = n_records
+
+        # Counters of this reader (see bam_stats)
+        self.stats = new_stats()
+        self.file_handler = None
+        self.generator_reads = None
+
+    def set_file_handler(self):
+        self.file_handler = open(self.path, "rb")
+        self.generator_reads = self.__generate_records()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.generator_reads)
+
+    def __generate_records(self):
+        time_start = perf_counter()
+        for _, read_data in itertools.islice(generate_reads_from_virtual_offset(self.file_handler, self.voffset_start, stats = self.stats), self.n_records):
+            self.stats["reads_emitted"] += 1
+            yield read_data
+        self.stats["time_elapsed"] = perf_counter() - time_start
+        self.__close_reader()
+
+    def __close_reader(self):
+        if hasattr(self.file_handler, "close"):
+            self.file_handler.close()
+
+    def __del__(self):
+        self.__close_reader()
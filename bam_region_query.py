@@ -0,0 +1,192 @@
+#%%
+from pathlib import Path
+import sys, os, re
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from read_bai import read_bai
+
+_bai_pseudo_bin = 37450 # Bin for metadata of reference, not for reads
+_regex_region = re.compile(r"^(?P<name>[^:]+)(:(?P<beg>[0-9,]+)(-(?P<end>[0-9,]+))?)?$")
+
+def find_bai_path(path_bam):
+    # "{path}.bai" or "{path without .bam}.bai"
+    for path_bai in [f"{path_bam}.bai", f"{os.path.splitext(path_bam)[0]}.bai"]:
+        if os.path.exists(path_bai):
+            return path_bai
+    raise FileNotFoundError(f"BAI index of {path_bam} does not exist")
+
+def read_bam_header(file_handler):
+    # Returns the header data, plain header text and reference information (refID -> {"name", "l_ref"})
+    header_data, _, _ = read_header_blocks(file_handler)
+    plain_header_text, dict_refID = extract_data_from_binary_bam_header(header_data)
+    return header_data, plain_header_text, dict_refID
+
+def read_header_blocks(file_handler):
+    # The header can span multiple blocks.
+    # Returns the header data, the blocks read ([coffset, length of data]) and the offset of the block after them
+    list_blocks = list()
+    header_data = b''
+    coffset = 0
+    while 1:
+        block_data, coffset_next = read_block_data_and_size_from_offset(file_handler, coffset)
+        if len(block_data) == 0:
+            raise ValueError("BAM header is truncated")
+        list_blocks.append([coffset, len(block_data)])
+        header_data += block_data
+        coffset = coffset_next
+        try:
+            len_header = get_length_of_binary_bam_header(header_data)
+            return header_data[:len_header], list_blocks, coffset_next
+        except struct.error:
+            continue
+
+def parse_region_string(region, dict_refID):
+    # "chr1", "chr1:1001" or "chr1:1001-2000" (1-based, inclusive) -> refID, 0-based start, 0-based exclusive end
+    match_region = _regex_region.match(region.strip())
+    assert match_region != None, f"Wrong region: {region}"
+    dict_name_to_refID = {dict_ref["name"]: refID for refID, dict_ref in dict_refID.items()}
+    name = match_region.group("name")
+    assert name in dict_name_to_refID, f"Reference {name} is not in BAM header"
+    refID = dict_name_to_refID[name]
+    beg = int(match_region.group("beg").replace(',', '')) - 1 if match_region.group("beg") else 0
+    end = int(match_region.group("end").replace(',', '')) if match_region.group("end") else dict_refID[refID]["l_ref"]
+    assert beg < end, f"Region start must be smaller than end: {region}"
+    return refID, max(beg, 0), end
+
+def get_bai_bin_to_chunks(dict_bai_ref):
+    # Bins of read_bai output are keyed by the order in the file. Key them by the bin number for lookup.
+    dict_bin_to_chunks = dict()
+    for dict_bin in dict_bai_ref["bins"].values():
+        if dict_bin["bin"] == _bai_pseudo_bin:
+            continue
+        dict_bin_to_chunks[dict_bin["bin"]] = [(chunk["begin"], chunk["end"]) for chunk in dict_bin["chunks"].values()]
+    return dict_bin_to_chunks
+
+def get_chunks_of_region(dict_bai_ref, beg, end, dict_bin_to_chunks = None):
+    # Sorted and merged chunks (virtual offsets [begin, end)) which may contain reads overlapping [beg, end)
+    if dict_bin_to_chunks == None:
+        dict_bin_to_chunks = get_bai_bin_to_chunks(dict_bai_ref)
+    # Linear index: reads overlapping the 16kbp window of "beg" never start before this offset
+    min_voffset = dict_bai_ref["intervals"].get(beg >> 14, 0)
+
+    list_chunks = list()
+    for bin_number in get_bins_of_region(beg, end):
+        for chunk_begin, chunk_end in dict_bin_to_chunks.get(bin_number, []):
+            if chunk_end > min_voffset:
+                list_chunks.append((max(chunk_begin, min_voffset), chunk_end))
+    list_chunks.sort()
+
+    list_merged_chunks = list()
+    for chunk_begin, chunk_end in list_chunks:
+        if len(list_merged_chunks) > 0 and chunk_begin <= list_merged_chunks[-1][1]:
+            list_merged_chunks[-1][1] = max(list_merged_chunks[-1][1], chunk_end)
+        else:
+            list_merged_chunks.append([chunk_begin, chunk_end])
+    return list_merged_chunks
+
+def get_virtual_offset_range_of_reference(dict_bai, refID):
+    # [start, end) virtual offsets of the reads of refID from BAI. None if the reference has no read.
+    if refID not in dict_bai:
+        return None
+    for dict_bin in dict_bai[refID]["bins"].values():
+        if dict_bin["bin"] == _bai_pseudo_bin and len(dict_bin["chunks"]) > 0:
+            # Pseudo-bin: The first chunk is [ref_beg, ref_end)
+            return dict_bin["chunks"][0]["begin"], dict_bin["chunks"][0]["end"]
+    list_chunks = [(chunk["begin"], chunk["end"]) for dict_bin in dict_bai[refID]["bins"].values() for chunk in dict_bin["chunks"].values()]
+    if len(list_chunks) == 0:
+        return None
+    return min(chunk[0] for chunk in list_chunks), max(chunk[1] for chunk in list_chunks)
+
+def read_block_data_and_size_from_offset(file_handler, coffset, cache = None, stats = None, file_key = None):
+    # Returns decompressed block data and the offset of the next block. Empty data at the end of file.
+    # Blocks are cached as (block data, compressed block size) with the key (file_key, coffset), so a cached block is returned without touching the file.
+    # file_key: Key of the file in the cache (path of file by default). Should change when the file is rewritten (e.g. with inode, size and mtime).
+    if cache != None:
+        key_cache = (file_key if file_key != None else file_handler.name, coffset)
+        cached = cache.get(key_cache)
+        if cached != None:
+            block_data, block_size = cached
+            return block_data, coffset + block_size
+    file_handler.seek(coffset)
+    block_header = file_handler.read(18)
+    if len(block_header) < 18:
+        return b'', coffset
+    block_size = struct.unpack("<H", block_header[16:18])[0] + 1
+    block_data = read_block_data_from_offset(file_handler, coffset, ignore_checking = True, stats = stats)
+    if cache != None:
+        cache.put(key_cache, (block_data, block_size), n_bytes = len(block_data))
+    return block_data, coffset + block_size
+
+def get_virtual_offset_after_header(file_handler):
+    # Virtual offset of the first read. The header can span multiple blocks.
+    header_data, list_blocks, coffset_next = read_header_blocks(file_handler)
+    len_header = len(header_data)
+    for coffset, len_block in list_blocks:
+        if len_header < len_block:
+            return make_virtual_offset_from_bytes(coffset) | len_header
+        len_header -= len_block
+    return make_virtual_offset_from_bytes(coffset_next)
+
+def generate_reads_from_virtual_offset(file_handler, voffset_start, voffset_end = None, cache = None, stats = None, file_key = None):
+    # Yield (virtual offset, read data) from voffset_start until voffset_end (exclusive) or the end of file
+    # Unlike BamPartReader, reads spanning multiple blocks are supported
+    coffset, within_block = split_virtual_offset(voffset_start)
+    block_data, coffset_next = read_block_data_and_size_from_offset(file_handler, coffset, cache, stats, file_key)
+    # Blocks in buffer: [coffset, length of data]
+    list_buffer_blocks = [[coffset, len(block_data)]]
+    buffer = block_data
+    ind_read = within_block
+
+    def extend_buffer():
+        nonlocal buffer, coffset_next
+        block_data, coffset_after = read_block_data_and_size_from_offset(file_handler, coffset_next, cache, stats, file_key)
+        if len(block_data) == 0:
+            return False
+        list_buffer_blocks.append([coffset_next, len(block_data)])
+        buffer += block_data
+        coffset_next = coffset_after
+        return True
+
+    while 1:
+        # Drop the blocks which are already read
+        while ind_read >= list_buffer_blocks[0][1]:
+            if len(list_buffer_blocks) == 1 and not extend_buffer():
+                return
+            ind_read -= list_buffer_blocks[0][1]
+            buffer = buffer[list_buffer_blocks[0][1]:]
+            list_buffer_blocks.pop(0)
+
+        voffset_read = make_virtual_offset_from_bytes(list_buffer_blocks[0][0]) | ind_read
+        if voffset_end != None and voffset_read >= voffset_end:
+            return
+
+        while len(buffer) - ind_read < 4:
+            if not extend_buffer():
+                return
+        block_size = struct.unpack_from("<I", buffer, ind_read)[0]
+        while len(buffer) - ind_read < 4 + block_size:
+            if not extend_buffer():
+                raise RuntimeError(f"Truncated read at virtual offset {voffset_read}")
+
+        yield voffset_read, buffer[ind_read+4:ind_read+4+block_size]
+        ind_read += 4 + block_size
+
+def fetch_region_reads(file_handler, dict_bai, refID, beg, end, cache = None, dict_bin_to_chunks = None, max_reads = None, stats = None, file_key = None):
+    # Reads overlapping [beg, end) (0-based) of a coordinate-sorted BAM, using BAI
+    # max_reads: Return at most this number of reads (no read if it is less than 1)
+    list_reads_data = list()
+    if refID not in dict_bai or (max_reads != None and max_reads < 1):
+        return list_reads_data
+    for chunk_begin, chunk_end in get_chunks_of_region(dict_bai[refID], beg, end, dict_bin_to_chunks):
+        for voffset, read_data in generate_reads_from_virtual_offset(file_handler, chunk_begin, chunk_end, cache, stats, file_key):
+            read_refID, read_pos = struct.unpack_from("<ii", read_data, 0)
+            if read_refID != refID or read_pos >= end:
+                # Reads are sorted, so the rest of chunk is out of region
+                break
+            if get_reference_end_of_read(read_data) <= beg:
+                continue
+            list_reads_data.append(read_data)
+            if max_reads != None and len(list_reads_data) >= max_reads:
+                return list_reads_data
+    return list_reads_data
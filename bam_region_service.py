@@ -0,0 +1,306 @@
+#%%
+from pathlib import Path
+import sys, os, json, asyncio, argparse, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_region_query import *
+from bgzf_block_cache import BgzfBlockCache
+from bam_stats import *
+
+_http_status_text = {200:"OK", 400:"Bad Request", 403:"Forbidden", 404:"Not Found", 500:"Internal Server Error"}
+
+class BadRequestError(Exception):
+    # Wrong query from the client (HTTP 400). Other errors during a query are internal errors (HTTP 500).
+    pass
+
+class BamHandle():
+    # Parsed header, BAI and open file handlers of a single BAM
+    # File handlers are not shared between threads. Each query takes one from the idle handlers and gives it back.
+    # A closed (e.g. evicted from the pool) BamHandle closes the idle handlers at once, and the handlers in use when they are released.
+    def __init__(self, path_bam):
+        self.path = path_bam
+        self.path_bai = find_bai_path(path_bam)
+        # Identities of BAM and BAI when they were loaded, to detect files rewritten in place.
+        # Taken before reading, so a file changed while loading is detected at the next query.
+        self.file_identity = get_file_identity(self.path)
+        self.bai_identity = get_file_identity(self.path_bai)
+        # Key of the blocks of this BAM in the shared cache. Blocks of a rewritten BAM are never returned for the new one.
+        self.file_key = (self.path,) + self.file_identity
+        self.dict_bai = read_bai(self.path_bai, verbose = False)
+        self.dict_refID_to_bin_to_chunks = {refID: get_bai_bin_to_chunks(dict_bai_ref) for refID, dict_bai_ref in self.dict_bai.items()}
+
+        self.__lock = threading.Lock()
+        self.__list_idle_file_handlers = list()
+        self.__is_closed = False
+        file_handler = self.acquire_file_handler()
+        try:
+            self.header_data, self.plain_header_text, self.dict_refID = read_bam_header(file_handler)
+        finally:
+            self.release_file_handler(file_handler)
+
+    def is_modified(self):
+        # True if BAM or BAI was rewritten, replaced or removed after it was loaded
+        try:
+            return get_file_identity(self.path) != self.file_identity or get_file_identity(self.path_bai) != self.bai_identity
+        except FileNotFoundError:
+            return True
+
+    def acquire_file_handler(self):
+        with self.__lock:
+            if len(self.__list_idle_file_handlers) > 0:
+                return self.__list_idle_file_handlers.pop()
+        return open(self.path, "rb")
+
+    def release_file_handler(self, file_handler):
+        with self.__lock:
+            if not self.__is_closed:
+                self.__list_idle_file_handlers.append(file_handler)
+                return
+        file_handler.close()
+
+    def close(self):
+        with self.__lock:
+            self.__is_closed = True
+            list_file_handlers = self.__list_idle_file_handlers
+            self.__list_idle_file_handlers = list()
+        for file_handler in list_file_handlers:
+            file_handler.close()
+
+class BamHandlePool():
+    # Keep up to "max_open" BAMs open with their headers and BAI warm, and share a decompressed block cache between them
+    #   list_allowed_dirs: Only BAMs under these directories are served
+    def __init__(self, list_allowed_dirs, max_open = 256, cache_max_bytes = 256 * 1024 * 1024, cache_policy = "lru"):
+        assert len(list_allowed_dirs) > 0, "At least one directory must be allowed"
+        self.list_allowed_dirs = [os.path.realpath(path_dir) for path_dir in list_allowed_dirs]
+        self.max_open = max_open
+        self.cache = BgzfBlockCache(cache_max_bytes, cache_policy, thread_safe = True)
+
+        self.__lock = threading.Lock()
+        self.__dict_path_to_bam_handle = OrderedDict()
+        self.n_opened = 0
+        self.n_queries = 0
+        self.stats = new_stats()
+
+    def get_bam_handle(self, path_bam):
+        path_bam = os.path.realpath(path_bam)
+        if not any(os.path.commonpath([path_bam, path_dir]) == path_dir for path_dir in self.list_allowed_dirs):
+            raise PermissionError(f"{path_bam} is not under the allowed directories")
+        with self.__lock:
+            bam_handle = self.__dict_path_to_bam_handle.get(path_bam)
+        # BAM or BAI rewritten after it was opened is opened again
+        if bam_handle != None and not bam_handle.is_modified():
+            with self.__lock:
+                if path_bam in self.__dict_path_to_bam_handle:
+                    self.__dict_path_to_bam_handle.move_to_end(path_bam)
+            return bam_handle
+        # Open outside the lock, so that loading a large BAI does not block queries of other BAMs
+        bam_handle = BamHandle(path_bam)
+        with self.__lock:
+            bam_handle_pooled = self.__dict_path_to_bam_handle.get(path_bam)
+            if bam_handle_pooled != None and bam_handle_pooled.file_key == bam_handle.file_key and bam_handle_pooled.bai_identity == bam_handle.bai_identity:
+                bam_handle.close()
+                return bam_handle_pooled
+            if bam_handle_pooled != None:
+                del self.__dict_path_to_bam_handle[path_bam]
+                bam_handle_pooled.close()
+            self.__dict_path_to_bam_handle[path_bam] = bam_handle
+            self.n_opened += 1
+            while len(self.__dict_path_to_bam_handle) > self.max_open:
+                _, bam_handle_evicted = self.__dict_path_to_bam_handle.popitem(last = False)
+                bam_handle_evicted.close()
+        return bam_handle
+
+    def query_region(self, path_bam, region, max_reads = None, only_count = False):
+        bam_handle = self.get_bam_handle(path_bam)
+        try:
+            refID, beg, end = parse_region_string(region, bam_handle.dict_refID)
+        except AssertionError as error:
+            raise BadRequestError(str(error))
+        stats = new_stats()
+        file_handler = bam_handle.acquire_file_handler()
+        try:
+            list_reads_data = fetch_region_reads(
+                file_handler, bam_handle.dict_bai, refID, beg, end,
+                cache = self.cache,
+                dict_bin_to_chunks = bam_handle.dict_refID_to_bin_to_chunks.get(refID),
+                max_reads = max_reads,
+                stats = stats,
+                file_key = bam_handle.file_key
+            )
+        finally:
+            bam_handle.release_file_handler(file_handler)
+        with self.__lock:
+            self.n_queries += 1
+            for key in ["bytes_read", "blocks_inflated", "time_io", "time_inflate"]:
+                self.stats[key] += stats[key]
+
+        dict_result = {
+            "path" : path_bam,
+            "region" : {"name":bam_handle.dict_refID[refID]["name"], "start":beg+1, "end":end},
+            "n_reads" : len(list_reads_data),
+        }
+        if not only_count:
+            dict_result["reads"] = [get_read_summary(read_data, bam_handle.dict_refID) for read_data in list_reads_data]
+        return dict_result
+
+    def get_pool_stats(self):
+        with self.__lock:
+            n_open = len(self.__dict_path_to_bam_handle)
+        return {
+            "n_open" : n_open,
+            "n_opened" : self.n_opened,
+            "n_queries" : self.n_queries,
+            "reader" : dict(self.stats),
+            "cache" : self.cache.get_cache_stats()
+        }
+
+    def close(self):
+        with self.__lock:
+            for bam_handle in self.__dict_path_to_bam_handle.values():
+                bam_handle.close()
+            self.__dict_path_to_bam_handle.clear()
+
+def get_file_identity(path_file):
+    # (inode, size, modification time), which changes when the file is rewritten or replaced
+    stat_file = os.stat(path_file)
+    return stat_file.st_ino, stat_file.st_size, stat_file.st_mtime_ns
+
+def get_read_summary(read_data, dict_refID):
+    # Core fields of a read for JSON, without decoding sequence, quality and tags
+    refID, pos, l_read_name, mapq, _, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen = struct.unpack_from("<iiBBHHHIiii", read_data, 0)
+    read_name = read_data[32:32+l_read_name-1].decode()
+    list_cigar = list(struct.unpack_from(f"<{n_cigar_op}I", read_data, 32+l_read_name))
+    return {
+        "name" : read_name,
+        "flag" : flag,
+        "ref" : dict_refID[refID]["name"] if refID >= 0 else "*",
+        "pos" : pos + 1,
+        "mapq" : mapq,
+        "cigar" : convert_cigar_list_to_cigarstring(list_cigar) if n_cigar_op > 0 else "*",
+        "next_ref" : dict_refID[next_refID]["name"] if next_refID >= 0 else "*",
+        "next_pos" : next_pos + 1,
+        "tlen" : tlen,
+        "end" : get_reference_end_of_read(read_data),
+    }
+
+class BamRegionService():
+    # Localhost HTTP (or Unix socket) service for region queries
+    #   GET /region?path=<BAM>&region=chr1:1001-2000[&limit=<max reads>][&count=1]
+    #   GET /stats
+    # Queries run in a thread pool, so that decompression of blocks does not block the event loop.
+    def __init__(self, bam_handle_pool, n_threads = 8):
+        self.pool = bam_handle_pool
+        self.executor = ThreadPoolExecutor(max_workers = n_threads)
+        self.server = None
+
+    async def start(self, host = "127.0.0.1", port = 8765, path_unix_socket = None):
+        if path_unix_socket != None:
+            self.server = await asyncio.start_unix_server(self.__handle_connection, path = path_unix_socket)
+        else:
+            self.server = await asyncio.start_server(self.__handle_connection, host = host, port = port)
+        return self.server
+
+    async def serve_forever(self, host = "127.0.0.1", port = 8765, path_unix_socket = None):
+        server = await self.start(host, port, path_unix_socket)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        if self.server != None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait = False)
+        self.pool.close()
+
+    async def __handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, so that repeated small queries do not pay for new connections
+        try:
+            while 1:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                dict_headers = dict()
+                while 1:
+                    header_line = await reader.readline()
+                    if header_line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = header_line.decode("latin-1").partition(":")
+                    dict_headers[key.strip().lower()] = value.strip()
+
+                status, dict_body = await self.__handle_request(request_line.decode("latin-1"))
+                body = json.dumps(dict_body).encode()
+                is_keep_alive = dict_headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {_http_status_text[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if is_keep_alive else 'close'}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+                if not is_keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def __handle_request(self, request_line):
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            return 400, {"error":"Wrong request line"}
+        if method != "GET":
+            return 400, {"error":"Only GET is supported"}
+
+        url = urlsplit(target)
+        dict_query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        loop = asyncio.get_running_loop()
+        try:
+            if url.path == "/region":
+                if "path" not in dict_query or "region" not in dict_query:
+                    return 400, {"error":"Both 'path' and 'region' are required"}
+                try:
+                    max_reads = int(dict_query["limit"]) if "limit" in dict_query else None
+                except ValueError:
+                    return 400, {"error":f"Wrong limit: {dict_query['limit']}"}
+                if max_reads != None and max_reads < 1:
+                    return 400, {"error":f"Limit must be positive: {max_reads}"}
+                only_count = dict_query.get("count", "0") not in ("0", "false", "")
+                dict_result = await loop.run_in_executor(self.executor, self.pool.query_region, dict_query["path"], dict_query["region"], max_reads, only_count)
+                return 200, dict_result
+            elif url.path == "/stats":
+                return 200, self.pool.get_pool_stats()
+            else:
+                return 404, {"error":f"Unknown path: {url.path}"}
+        except PermissionError as error:
+            return 403, {"error":str(error)}
+        except FileNotFoundError as error:
+            return 404, {"error":str(error)}
+        except BadRequestError as error:
+            return 400, {"error":str(error)}
+        except Exception as error:
+            return 500, {"error":repr(error)}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Region query service for indexed BAM files")
+    parser.add_argument("--allowed-dir", action = "append", required = True, help = "Directory of BAM files to serve (can be repeated)")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--unix-socket", default = None, help = "Serve on this Unix socket instead of TCP")
+    parser.add_argument("--threads", type = int, default = 8)
+    parser.add_argument("--max-open", type = int, default = 256)
+    parser.add_argument("--cache-mb", type = int, default = 256)
+    parser.add_argument("--cache-policy", choices = ["lru", "clock"], default = "lru")
+    args = parser.parse_args()
+
+    pool = BamHandlePool(args.allowed_dir, args.max_open, args.cache_mb * 1024 * 1024, args.cache_policy)
+    service = BamRegionService(pool, args.threads)
+    asyncio.run(service.serve_forever(args.host, args.port, args.unix_socket))
+
+#%%
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#%%
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_util import _bgzf_eof, _size_max_block_data
+from bam_region_query import *
+from bam_record_index import *
+from bam_stats import *
+
+_size_copy_chunk = 16 * 1024 * 1024
+
+class BamRegionSlicer():
+    # Extract a region (e.g. a chromosome) or a range of records from BAM into a new BAM
+    # Blocks lying entirely in the range are copied without decompression. Only the first and last blocks are re-encoded,
+    # with the reads starting before a region, which are checked one by one.
+    #   path_bai: BAI of coordinate-sorted BAM, for slicing regions (found beside the BAM if not given)
+    #   path_record_index: Record count index (bam_record_index), for slicing by record number (built if it does not exist)
+    def __init__(self, path_file, path_bai = None, path_record_index = None, compresslevel = 6):
+        self.path = path_file
+        self.path_bai = path_bai
+        self.path_record_index = path_record_index
+        self.compresslevel = compresslevel
+
+        self.header_data = None
+        self.plain_header_text = None
+        self.dict_refID = dict()
+
+        # Stats of slicing (see bam_stats), with "bytes_copied": Bytes of compressed blocks copied as they are
+        self.stats = dict()
+
+    def run_slicing(self, region, path_save):
+        # region: "chr1", "chr1:1001" or "chr1:1001-2000" (1-based, inclusive)
+        # Output: Reads overlapping the region, same as "samtools view" of the region
+        time_start = perf_counter()
+        dict_bai = read_bai(self.path_bai if self.path_bai != None else find_bai_path(self.path))
+        with open(self.path, "rb") as file_reader:
+            self.__read_header(file_reader)
+            refID, beg, end = parse_region_string(region, self.dict_refID)
+            voffset_range = get_virtual_offset_range_of_region(file_reader, dict_bai, refID, beg, end, self.dict_refID[refID]["l_ref"])
+            self.stats = new_stats()
+            with open(path_save, "wb") as file_writer:
+                self.__write_header(file_writer)
+                if voffset_range != None:
+                    voffset_start, voffset_copy_start, voffset_end = voffset_range
+                    write_reads_overlapping_region(file_reader, file_writer, voffset_start, voffset_copy_start, beg, self.stats, self.compresslevel)
+                    copy_virtual_offset_range(file_reader, file_writer, voffset_copy_start, voffset_end, self.stats, self.compresslevel)
+                write_eof(file_writer)
+        self.stats["time_elapsed"] = perf_counter() - time_start
+
+    def run_slicing_records(self, n_start, n_end, path_save):
+        # Records [n_start, n_end) in the order of BAM (no need to be sorted)
+        time_start = perf_counter()
+        if self.path_record_index == None:
+            record_index = load_or_build_record_index(self.path)
+        else:
+            record_index = BamRecordIndex().load(self.path_record_index)
+        n_end = min(n_end, record_index.n_records)
+        with open(self.path, "rb") as file_reader:
+            self.__read_header(file_reader)
+            voffset_range = None
+            if n_start < n_end:
+                voffset_start = record_index.get_virtual_offset_of_record(file_reader, n_start)
+                voffset_end = record_index.get_virtual_offset_of_record(file_reader, n_end)
+                voffset_range = (voffset_start, voffset_end)
+            self.stats = new_stats()
+            with open(path_save, "wb") as file_writer:
+                self.__write_header(file_writer)
+                if voffset_range != None:
+                    copy_virtual_offset_range(file_reader, file_writer, voffset_range[0], voffset_range[1], self.stats, self.compresslevel)
+                write_eof(file_writer)
+        self.stats["time_elapsed"] = perf_counter() - time_start
+
+    def __read_header(self, file_reader):
+        self.header_data, self.plain_header_text, self.dict_refID = read_bam_header(file_reader)
+
+    def __write_header(self, file_writer):
+        for ind in range(0, len(self.header_data), _size_max_block_data):
+            write_block(file_writer, self.header_data[ind:ind+_size_max_block_data], stats = self.stats, compresslevel = self.compresslevel)
+
+def get_virtual_offset_range_of_region(file_handler, dict_bai, refID, beg, end, l_ref):
+    # Virtual offsets [start, copy start, end) of the reads overlapping [beg, end). None if no read overlaps the region.
+    #   [start, copy start): Reads starting before "beg", from the first read overlapping the region. Reads ending before "beg" must be removed.
+    #   [copy start, end): Reads starting in the region, which all overlap it
+    voffset_range_ref = get_virtual_offset_range_of_reference(dict_bai, refID)
+    if voffset_range_ref == None:
+        return None
+
+    voffset_start = None
+    for chunk_begin, chunk_end in get_chunks_of_region(dict_bai[refID], beg, end):
+        for voffset, read_data in generate_reads_from_virtual_offset(file_handler, chunk_begin, chunk_end):
+            read_refID, read_pos = struct.unpack_from("<ii", read_data, 0)
+            if read_refID != refID or read_pos >= end:
+                break
+            if get_reference_end_of_read(read_data) > beg:
+                voffset_start = voffset
+                break
+        if voffset_start != None:
+            break
+    if voffset_start == None:
+        return None
+    if beg == 0 and end >= l_ref:
+        return voffset_start, voffset_start, voffset_range_ref[1]
+
+    voffset_copy_start = voffset_range_ref[1]
+    for voffset, read_data in generate_reads_from_virtual_offset(file_handler, voffset_start, voffset_range_ref[1]):
+        read_refID, read_pos = struct.unpack_from("<ii", read_data, 0)
+        if read_refID != refID or read_pos >= beg:
+            voffset_copy_start = voffset
+            break
+
+    # Reads starting at or after the 16kbp window of "end" are after its linear index, so only the reads from there are checked
+    voffset_scan = max(voffset_copy_start, dict_bai[refID]["intervals"].get(end >> 14, 0))
+    voffset_end = voffset_range_ref[1]
+    for voffset, read_data in generate_reads_from_virtual_offset(file_handler, voffset_scan, voffset_range_ref[1]):
+        read_refID, read_pos = struct.unpack_from("<ii", read_data, 0)
+        if read_refID != refID or read_pos >= end:
+            voffset_end = voffset
+            break
+    return voffset_start, voffset_copy_start, voffset_end
+
+def write_reads_overlapping_region(file_reader, file_writer, voffset_start, voffset_end, beg, stats = None, compresslevel = 6):
+    # Re-encode the reads in [voffset_start, voffset_end) which end after "beg"
+    buffer = b''
+    for _, read_data in generate_reads_from_virtual_offset(file_reader, voffset_start, voffset_end, stats = stats):
+        if get_reference_end_of_read(read_data) <= beg:
+            continue
+        buffer += struct.pack("<I", len(read_data)) + read_data
+        while len(buffer) >= _size_max_block_data:
+            write_block(file_writer, buffer[:_size_max_block_data], stats = stats, compresslevel = compresslevel)
+            buffer = buffer[_size_max_block_data:]
+    if len(buffer) > 0:
+        write_block(file_writer, buffer, stats = stats, compresslevel = compresslevel)
+
+def copy_virtual_offset_range(file_reader, file_writer, voffset_start, voffset_end = None, stats = None, compresslevel = 6):
+    # Write the data in [voffset_start, voffset_end) as BGZF blocks
+    # Complete blocks are copied as they are. The partial first and last blocks are re-encoded.
+    # voffset_end: None for the end of file
+    coffset_start, within_start = split_virtual_offset(voffset_start)
+    if voffset_end == None:
+        coffset_end, within_end = get_offset_of_eof(file_reader), 0
+    else:
+        coffset_end, within_end = split_virtual_offset(voffset_end)
+
+    if coffset_start == coffset_end:
+        block_data, _ = read_block_data_and_size_from_offset(file_reader, coffset_start, stats = stats)
+        if within_end > within_start:
+            write_block(file_writer, block_data[within_start:within_end], stats = stats, compresslevel = compresslevel)
+        return
+
+    coffset_copy_start = coffset_start
+    if within_start > 0:
+        block_data, coffset_copy_start = read_block_data_and_size_from_offset(file_reader, coffset_start, stats = stats)
+        if within_start < len(block_data):
+            write_block(file_writer, block_data[within_start:], stats = stats, compresslevel = compresslevel)
+
+    copy_compressed_blocks(file_reader, file_writer, coffset_copy_start, coffset_end, stats)
+
+    if within_end > 0:
+        block_data, _ = read_block_data_and_size_from_offset(file_reader, coffset_end, stats = stats)
+        write_block(file_writer, block_data[:within_end], stats = stats, compresslevel = compresslevel)
+
+def copy_compressed_blocks(file_reader, file_writer, coffset_start, coffset_end, stats = None):
+    # Byte-for-byte copy of the blocks in [coffset_start, coffset_end)
+    file_reader.seek(coffset_start)
+    n_bytes_rest = coffset_end - coffset_start
+    while n_bytes_rest > 0:
+        time_io_start = perf_counter()
+        data = file_reader.read(min(_size_copy_chunk, n_bytes_rest))
+        time_write_start = perf_counter()
+        file_writer.write(data)
+        n_bytes_rest -= len(data)
+        if stats is not None:
+            stats["time_io"] += time_write_start - time_io_start
+            stats["time_write"] += perf_counter() - time_write_start
+            stats["bytes_read"] += len(data)
+            stats["bytes_written"] += len(data)
+            stats["bytes_copied"] = stats.get("bytes_copied", 0) + len(data)
+        if len(data) == 0:
+            raise RuntimeError(f"File ends before offset {coffset_end}")
+
+def get_offset_of_eof(file_handler):
+    # Offset of the EOF block, or the end of file if there is no EOF block
+    filesize = file_handler.seek(0, 2)
+    file_handler.seek(max(filesize - len(_bgzf_eof), 0))
+    if file_handler.read(len(_bgzf_eof)) == _bgzf_eof:
+        return filesize - len(_bgzf_eof)
+    return filesize
@@ -0,0 +1,142 @@
+#%%
+from time import perf_counter
+import threading, multiprocessing
+
+# Counters collected by the readers / writers. Times are in seconds.
+#   time_io: Reading compressed data from file
+#   time_inflate: Decompressing and checking blocks
+#   time_parse: Splitting blocks into reads (and filtering reads)
+#   time_compress: Compressing blocks
+#   time_write: Writing compressed blocks to file
+#   time_elapsed: Wall time since the worker started (including the time spent by the consumer of reads)
+_stats_counter_keys = [
+    "bytes_read",
+    "blocks_inflated",
+    "reads_emitted",
+    "bytes_written",
+    "blocks_compressed",
+    "cache_hits",
+    "cache_misses",
+    "time_io",
+    "time_inflate",
+    "time_parse",
+    "time_compress",
+    "time_write",
+    "time_elapsed",
+]
+
+def new_stats():
+    return dict.fromkeys(_stats_counter_keys, 0)
+
+def add_cache_stats(stats, cache_stats):
+    # cache_stats: BgzfBlockCache.get_cache_stats()
+    stats["cache_hits"] += cache_stats["n_hits"]
+    stats["cache_misses"] += cache_stats["n_misses"]
+
+def merge_stats(list_stats):
+    # Sum up the stats of workers (shards), and summarize the skew between them
+    dict_merged = new_stats()
+    for stats in list_stats:
+        for key in _stats_counter_keys:
+            dict_merged[key] += stats.get(key, 0)
+    # Workers run at the same time, so the elapsed time of merged stats is the slowest worker
+    dict_merged["time_elapsed"] = max([stats.get("time_elapsed", 0) for stats in list_stats], default = 0)
+    dict_merged.update(summarize_stats(dict_merged))
+
+    dict_merged["n_shards"] = len(list_stats)
+    list_reads_per_shard = [stats.get("reads_emitted", 0) for stats in list_stats]
+    list_time_per_shard = [stats.get("time_elapsed", 0) for stats in list_stats]
+    dict_merged["reads_per_shard"] = list_reads_per_shard
+    dict_merged["time_per_shard"] = list_time_per_shard
+    # Skew: The largest shard over the mean shard (1.0 is perfectly balanced)
+    dict_merged["skew_reads"] = get_skew(list_reads_per_shard)
+    dict_merged["skew_time"] = get_skew(list_time_per_shard)
+    return dict_merged
+
+def set_time_elapsed(stats, time_elapsed):
+    # Replace the elapsed time of merged stats by the wall time, when the workers did not all run at the same time
+    # (e.g. more jobs than processes, or batches run one after another), and update the derived values
+    stats["time_elapsed"] = time_elapsed
+    stats.update(summarize_stats(stats))
+    return stats
+
+def summarize_stats(stats):
+    # Derived values: throughput, cache hit rate and the fraction of time spent for I/O
+    time_io = stats["time_io"] + stats["time_write"]
+    time_cpu = stats["time_inflate"] + stats["time_parse"] + stats["time_compress"]
+    n_cache_access = stats["cache_hits"] + stats["cache_misses"]
+    return {
+        "cache_hit_rate" : stats["cache_hits"] / n_cache_access if n_cache_access > 0 else None,
+        "io_fraction" : time_io / (time_io + time_cpu) if time_io + time_cpu > 0 else None,
+        "MB_read_per_second" : stats["bytes_read"] / stats["time_elapsed"] / 1e6 if stats["time_elapsed"] > 0 else None,
+        "reads_per_second" : stats["reads_emitted"] / stats["time_elapsed"] if stats["time_elapsed"] > 0 else None,
+    }
+
+def get_skew(list_values):
+    if len(list_values) == 0 or sum(list_values) == 0:
+        return None
+    return max(list_values) / (sum(list_values) / len(list_values))
+
+class ProgressReporter():
+    # Call "callback(stats)" at most once every "interval" seconds
+    def __init__(self, callback, interval = 10):
+        self.callback = callback
+        self.interval = interval
+        self.__time_last_report = perf_counter()
+
+    def report(self, stats, force = False):
+        if self.callback == None:
+            return
+        time_now = perf_counter()
+        if force or time_now - self.__time_last_report >= self.interval:
+            self.__time_last_report = time_now
+            self.callback(stats)
+
+class ShardProgressSender():
+    # Callback of a shard which sends its stats to ProgressAggregator. Picklable, so it works in other processes (e.g. joblib workers).
+    def __init__(self, queue, ind_shard):
+        self.queue = queue
+        self.ind_shard = ind_shard
+
+    def __call__(self, stats):
+        self.queue.put((self.ind_shard, dict(stats)))
+
+class ProgressAggregator():
+    # Call "callback(merged stats of shards)" in this process at most once every "interval" seconds,
+    # with the latest stats sent by each shard (get_sender) between start() and stop()
+    def __init__(self, callback, interval = 10):
+        self.callback = callback
+        self.interval = interval
+        self.queue = None
+        self.__manager = None
+        self.__thread = None
+        self.__dict_shard_stats = dict()
+
+    def start(self):
+        self.__manager = multiprocessing.Manager()
+        self.queue = self.__manager.Queue()
+        self.__dict_shard_stats = dict()
+        self.__thread = threading.Thread(target = self.__receive_stats, daemon = True)
+        self.__thread.start()
+
+    def get_sender(self, ind_shard):
+        return ShardProgressSender(self.queue, ind_shard)
+
+    def stop(self):
+        # The stats of all shards are reported once more before it returns
+        self.queue.put(None)
+        self.__thread.join()
+        self.__manager.shutdown()
+        self.queue = None
+
+    def __receive_stats(self):
+        progress_reporter = ProgressReporter(self.callback, self.interval)
+        while 1:
+            item = self.queue.get()
+            if item == None:
+                break
+            ind_shard, stats = item
+            self.__dict_shard_stats[ind_shard] = stats
+            progress_reporter.report(merge_stats(list(self.__dict_shard_stats.values())))
+        if len(self.__dict_shard_stats) > 0:
+            progress_reporter.report(merge_stats(list(self.__dict_shard_stats.values())), force = True)
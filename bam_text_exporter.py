@@ -0,0 +1,199 @@
+#%%
+from pathlib import Path
+import os, sys, subprocess
+
+from joblib import Parallel, delayed
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_parallel_reader import *
+from bgzf_parallel_writer import BgzfParallelWriter
+from bam_stats import *
+
+_output_formats = ["sam", "fastq"]
+# Two bases per byte of "seq"
+_seq_byte_to_bases = [base_1 + base_2 for base_1 in "=ACMGRSVTWYHKDBN" for base_2 in "=ACMGRSVTWYHKDBN"]
+_phred_to_ascii = bytes((val + 33) & 0xFF for val in range(256))
+_complement_bases = str.maketrans("ACGTMRWSYKVHDBN=", "TGCAKYWSRMBDHVN=")
+# FASTQ quality of reads without quality (0xFF in BAM), same as "samtools fastq"
+_fastq_missing_qual = '"'
+
+class BamTextExporter():
+    # Convert BAM into SAM or FASTQ text
+    # Each split reader of BAMParallelReader is formatted in a separate process into its own part file, and the parts are concatenated in order.
+    #   output_format: "sam" (with header) or "fastq" (primary reads only, reverse-complemented back to the sequenced strand)
+    #   bgzf: Compress the output with BGZF (e.g. ".sam.gz", ".fastq.gz"), which is readable by gzip
+    #   buffer_size: Bytes of text formatted before writing
+    #   progress_callback: Called with the merged stats of the split readers at most once every "progress_interval" seconds
+    def __init__(self, path_file, parallel = 1, path_gzi = None, output_format = "sam", bgzf = False, compresslevel = 6, read_filter = None, buffer_size = 4 * 1024 * 1024, progress_callback = None, progress_interval = 10):
+        assert output_format in _output_formats, f"Output format must be one of {_output_formats}"
+        self.path = path_file
+        self.path_gzi = path_gzi
+        self.parallel = parallel
+        self.output_format = output_format
+        self.bgzf = bgzf
+        self.compresslevel = compresslevel
+        self.read_filter = read_filter
+        self.buffer_size = buffer_size
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+
+        self.plain_header_text = list()
+        self.dict_refID = dict()
+
+        # Stats of the split readers (see bam_stats). Formatting text is counted as "time_parse".
+        # With read_filter, "read_filter" has the number of reads removed by each clause (see bam_read_filter)
+        self.stats = dict()
+
+    def run_export(self, path_save):
+        print("Splitting BAM for parallelization...", flush = True)
+        bpr = BAMParallelReader(self.path, self.parallel, self.path_gzi, self.read_filter, self.progress_callback, self.progress_interval)
+        bpr.split_bgzip_bam_into_multiple_readers()
+        self.plain_header_text = bpr.plain_header_text
+        self.dict_refID = bpr.dict_refID
+
+        list_files_concat = list()
+        if self.output_format == "sam":
+            path_save_header = f"{path_save}.__tmp.header"
+            self.__write_sam_header(path_save_header)
+            list_files_concat.append(path_save_header)
+
+        print(f"Exporting reads to {self.output_format.upper()}...", flush = True)
+        list_path_parts = [f"{path_save}.__tmp.{ind}" for ind in range(len(bpr.list_splitted_bam_reader))]
+        with bpr.report_progress(), Parallel(n_jobs = self.parallel) as parallel:
+            list_shard_results = parallel(delayed(export_text_from_bam_reader)(
+                bam_reader,
+                path_save_part,
+                self.output_format,
+                self.dict_refID,
+                self.bgzf,
+                self.compresslevel,
+                self.buffer_size
+            ) for bam_reader, path_save_part in zip(bpr.list_splitted_bam_reader, list_path_parts))
+        self.stats = bpr.collect_stats([shard_result["stats"] for shard_result in list_shard_results])
+        if self.read_filter != None:
+            # The filters were consumed in the workers, so their stats are merged from the results
+            self.stats["read_filter"] = bpr.get_read_filter_stats([shard_result["filter_stats"] for shard_result in list_shard_results])
+        list_files_concat.extend(list_path_parts)
+
+        print("Concatenating parts...", flush = True)
+        subprocess.run(f"cat {' '.join(list_files_concat)} > {path_save}", shell = True)
+        [os.remove(path_tmp) for path_tmp in list_files_concat]
+        if self.bgzf:
+            write_eof(path_save)
+
+    def __write_sam_header(self, path_save_header):
+        header_text = self.plain_header_text.strip(b'\x00') if isinstance(self.plain_header_text, bytes) else self.plain_header_text.encode()
+        if len(header_text) > 0 and not header_text.endswith(b'\n'):
+            header_text += b'\n'
+        if self.bgzf:
+            writer = BgzfParallelWriter(path_save_header, n_threads = 1, compresslevel = self.compresslevel)
+            writer.write(header_text)
+            writer.close(add_eof = False)
+        else:
+            with open(path_save_header, "wb") as file_writer:
+                file_writer.write(header_text)
+
+def export_text_from_bam_reader(bam_reader, path_save_part, output_format, dict_refID, bgzf = False, compresslevel = 6, buffer_size = 4 * 1024 * 1024):
+    # Worker for a single BamPartReader shard. Returns the stats of the reader and of its read filter (None without filter).
+    bam_reader.set_file_handler()
+    stats = bam_reader.stats
+    if bgzf:
+        writer = BgzfParallelWriter(path_save_part, n_threads = 1, compresslevel = compresslevel, stats = stats)
+    else:
+        writer = open(path_save_part, "wb")
+
+    list_ref_names = [dict_refID[refID]["name"] for refID in range(len(dict_refID))]
+    list_lines = list()
+    size_buffer = 0
+    for read_data in bam_reader:
+        time_format_start = perf_counter()
+        if output_format == "sam":
+            line = convert_binary_read_to_sam_line(read_data, list_ref_names)
+        else:
+            line = convert_binary_read_to_fastq_record(read_data)
+            if line == None:
+                continue
+        list_lines.append(line)
+        size_buffer += len(line)
+        stats["time_parse"] += perf_counter() - time_format_start
+        if size_buffer >= buffer_size:
+            write_text_buffer(writer, list_lines, stats, bgzf)
+            list_lines = list()
+            size_buffer = 0
+    write_text_buffer(writer, list_lines, stats, bgzf)
+
+    if bgzf:
+        writer.close(add_eof = False)
+    else:
+        writer.close()
+    return {
+        "stats" : stats,
+        "filter_stats" : bam_reader.read_filter.get_filter_stats() if bam_reader.read_filter != None else None
+    }
+
+def write_text_buffer(writer, list_lines, stats, bgzf = False):
+    if len(list_lines) == 0:
+        return
+    data = ''.join(list_lines).encode()
+    if bgzf:
+        # Counters are added by BgzfParallelWriter
+        writer.write(data)
+        return
+    time_write_start = perf_counter()
+    writer.write(data)
+    stats["time_write"] += perf_counter() - time_write_start
+    stats["bytes_written"] += len(data)
+
+def get_seq_and_qual_of_binary_read(read_data, ind_seq, l_seq):
+    # Sequence and phred+33 quality strings. Quality is None if it is missing (0xFF).
+    bytes_seq = (l_seq+1)//2
+    seq = ''.join(map(_seq_byte_to_bases.__getitem__, read_data[ind_seq:ind_seq+bytes_seq]))[:l_seq]
+    qual_data = read_data[ind_seq+bytes_seq:ind_seq+bytes_seq+l_seq]
+    qual = None if l_seq == 0 or qual_data[0] == 0xFF else qual_data.translate(_phred_to_ascii).decode("latin-1")
+    return seq, qual
+
+def convert_binary_read_to_sam_line(read_data, list_ref_names):
+    # Single SAM line (with newline) of read data without "block_size"
+    refID, pos, l_read_name, mapq, _, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen = struct.unpack_from("<iiBBHHHIiii", read_data, 0)
+    read_name = read_data[32:32+l_read_name-1].decode()
+    ind_cigar = 32 + l_read_name
+    cigar = convert_cigar_list_to_cigarstring(struct.unpack_from(f"<{n_cigar_op}I", read_data, ind_cigar)) if n_cigar_op > 0 else "*"
+    ind_seq = ind_cigar + 4*n_cigar_op
+    seq, qual = get_seq_and_qual_of_binary_read(read_data, ind_seq, l_seq)
+
+    ref_name = list_ref_names[refID] if refID >= 0 else "*"
+    if next_refID < 0:
+        next_ref_name = "*"
+    elif next_refID == refID:
+        next_ref_name = "="
+    else:
+        next_ref_name = list_ref_names[next_refID]
+
+    list_fields = [
+        read_name, str(flag), ref_name, str(pos+1), str(mapq), cigar,
+        next_ref_name, str(next_pos+1), str(tlen),
+        seq if l_seq > 0 else "*",
+        qual if qual != None else "*",
+    ]
+    ind_tags = ind_seq + (l_seq+1)//2 + l_seq
+    if ind_tags < len(read_data):
+        list_fields.append(convert_tags_to_sam_string(extract_tags_from_binary_read(read_data, ind_tags)))
+    return '\t'.join(list_fields) + '\n'
+
+def convert_binary_read_to_fastq_record(read_data, add_mate_suffix = True):
+    # FASTQ record of a primary read. None for secondary or supplementary reads.
+    # Reads on the reverse strand are reverse-complemented, so the record is the sequenced read.
+    l_read_name, n_cigar_op, flag, l_seq = struct.unpack_from("<B3xHHI", read_data, 8)
+    if flag & 0x900:
+        return None
+    read_name = read_data[32:32+l_read_name-1].decode()
+    if add_mate_suffix and flag & 0x1:
+        read_name += "/1" if flag & 0x40 else "/2" if flag & 0x80 else ""
+    seq, qual = get_seq_and_qual_of_binary_read(read_data, 32 + l_read_name + 4*n_cigar_op, l_seq)
+    if qual == None:
+        qual = _fastq_missing_qual * l_seq
+    if flag & 0x10:
+        seq = seq.translate(_complement_bases)[::-1]
+        qual = qual[::-1]
+    return f"@{read_name}\n{seq}\n+\n{qual}\n"
@@ -1,13 +1,14 @@
 #%%
 import numpy as np
 import struct,math,re,sys,zlib
-from time import time
+from time import time, perf_counter
 from functools import lru_cache
 
 
 _bgzf_magic = b"\x1f\x8b\x08\x04"
 _bgzf_header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
 _bgzf_eof = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+_size_max_block_data = 65280 # Same as bgzip / samtools, so that compressed block never exceeds 65536 bytes
 _bytes_BC = b"BC"
 
 _bam_read_binary_format_order = [
@@ -66,6 +67,14 @@ def read_bgzip_index(path_gzi):
             
     return list_coffset_of_block_start, list_ucoffset_of_block_start
 
+def write_bgzip_index(path_gzi, list_coffset_of_block_start, list_ucoffset_of_block_start):
+    # Inverse of read_bgzip_index. The first block (offset 0) is not written in GZI.
+    list_offsets = [(coffset, ucoffset) for coffset, ucoffset in zip(list_coffset_of_block_start, list_ucoffset_of_block_start) if coffset != 0]
+    with open(path_gzi, "wb") as handle:
+        handle.write(struct.pack("<Q", len(list_offsets)))
+        for coffset, ucoffset in list_offsets:
+            handle.write(struct.pack("<QQ", coffset, ucoffset))
+
 def make_virtual_offset_from_bytes(bsize):
     return bsize << 16
 
@@ -74,13 +83,16 @@ def split_virtual_offset(virtual_offset):
     within_block = virtual_offset ^ (bsize << 16)
     return bsize, within_block    
 
-def load_bgzf_block(handle, text_mode=False):
+def load_bgzf_block(handle, text_mode=False, stats=None):
     """Load the next BGZF block of compressed data (PRIVATE).
 
     Returns a tuple (block size and data), or at end of file
     will raise StopIteration.
+    stats: Optional dict (bam_stats.new_stats) to add I/O and inflation counters
     ** Copied code from Biopython Github **
     """
+    if stats is not None:
+        time_start = perf_counter()
     magic = handle.read(4)
     if not magic:
         # End of file - should we signal this differently now?
@@ -115,10 +127,13 @@ def load_bgzf_block(handle, text_mode=False):
         raise ValueError("Missing BC, this isn't a BGZF file!")
     # Now comes the compressed data, CRC, and length of uncompressed data.
     deflate_size = block_size - 1 - extra_len - 19
-    d = zlib.decompressobj(-15)  # Negative window size means no headers
-    data = d.decompress(handle.read(deflate_size)) + d.flush()
+    deflate_data = handle.read(deflate_size)
     expected_crc = handle.read(4)
     expected_size = struct.unpack("<I", handle.read(4))[0]
+    if stats is not None:
+        time_inflate_start = perf_counter()
+    d = zlib.decompressobj(-15)  # Negative window size means no headers
+    data = d.decompress(deflate_data) + d.flush()
     if expected_size != len(data):
         raise RuntimeError("Decompressed to %i, not %i" % (len(data), expected_size))
     # Should cope with a mix of Python platforms...
@@ -129,6 +144,12 @@ def load_bgzf_block(handle, text_mode=False):
         crc = struct.pack("<I", crc)
     if expected_crc != crc:
         raise RuntimeError(f"CRC is {crc}, not {expected_crc}")
+    if stats is not None:
+        time_end = perf_counter()
+        stats["time_io"] += time_inflate_start - time_start
+        stats["time_inflate"] += time_end - time_inflate_start
+        stats["bytes_read"] += block_size
+        stats["blocks_inflated"] += 1
     if text_mode:
         # Note ISO-8859-1 aka Latin-1 preserves first 256 chars
         # (i.e. ASCII), but critically is a single byte encoding
@@ -136,13 +157,16 @@ def load_bgzf_block(handle, text_mode=False):
     else:
         return block_size, data
     
-def load_bgzf_block_compact(handle, text_mode=False):
+def load_bgzf_block_compact(handle, text_mode=False, stats=None):
     """Load the next BGZF block of compressed data (PRIVATE).
 
     Returns a tuple (block size and data), or at end of file
     will raise StopIteration.
+    stats: Optional dict (bam_stats.new_stats) to add I/O and inflation counters
     ** Copied code from Biopython Github **
     """
+    if stats is not None:
+        time_start = perf_counter()
     cblock = handle.read(18)
     extra_len = struct.unpack("<H", cblock[10:12])[0]
 
@@ -152,8 +176,15 @@ def load_bgzf_block_compact(handle, text_mode=False):
     deflate_size = block_size - 1 - extra_len - 19
     
     data_with_sizeinfo = handle.read(deflate_size+8)
+    if stats is not None:
+        time_inflate_start = perf_counter()
     d = zlib.decompressobj(-15)  # Negative window size means no headers
     data = d.decompress(data_with_sizeinfo[:deflate_size]) + d.flush()
+    if stats is not None:
+        stats["time_io"] += time_inflate_start - time_start
+        stats["time_inflate"] += perf_counter() - time_inflate_start
+        stats["bytes_read"] += block_size
+        stats["blocks_inflated"] += 1
     
     return data
 
@@ -235,18 +266,19 @@ def extract_data_from_binary_read(read_data):
         elif val_type == 'H':
             # Special case: list of hexhex
             ind_end, value = get_parsed_data_and_end_index_of_binary_characters_until_null(btr_data, 3)
-            value = [get_part_of_binary_string(value, ind, len_data = 2) for ind in range(0, len(value), 2)]            
+            value = [get_part_of_binary_string(value, ind, len_data = 2) for ind in range(0, len(value), 2)]
+            n_for_this_tag += (ind_end-2)
         elif val_type == 'B':
             # Special case: list of typed data
             val_type = get_part_of_binary_string(btr_data, 3).decode()
-            val_length = struct.unpack("<I", get_part_of_binary_string(btr_data, 4, len_data=4))
+            val_length = struct.unpack("<I", get_part_of_binary_string(btr_data, 4, len_data=4))[0]
             
             fmt_value = _bam_tag_type[val_type]["fmt"]
             byte_len_value = _bam_tag_type[val_type]["byte_len"]
             
             total_bytes_of_value = byte_len_value * val_length
-            value_binary = get_part_of_binary_string(btr_data, 8, total_bytes_of_value)
-            value = [struct.unpack(fmt_value, get_part_of_binary_string(value_binary, ind, len_data = byte_len_value)) for ind in range(0, len(value_binary, byte_len_value))]
+            value_binary = bytes(btr_data[8:8+total_bytes_of_value])
+            value = list(struct.unpack(f"<{val_length}{fmt_value[1:]}", value_binary))
             n_for_this_tag += 5 + total_bytes_of_value # 5: byte of val_type (1) + bytes of val_length (4)
         else:
             raise Exception(f"Wrong Datatype: {val_type}") 
@@ -256,7 +288,7 @@ def extract_data_from_binary_read(read_data):
 
 def convert_binary_to_seq(data, len_data):
     dict_val_to_seq = dict(zip(range(16), "=ACMGRSVTWYHKDBN"))
-    hex_val = list(map(int,data.hex()))
+    hex_val = list(map(lambda val: int(val, 16), data.hex()))
     seq = ''.join(list(map(dict_val_to_seq.__getitem__, hex_val))[:len_data])
     return seq
 
@@ -276,6 +308,57 @@ def convert_cigar_list_to_cigarstring(list_cigar):
         list_str_cigar.append(op_str)
     return ''.join(list_str_cigar)
 
+def get_start_index_of_tags_of_binary_read(read_data):
+    # Tags follow read name, cigar, seq and qual
+    l_read_name, n_cigar_op, l_seq = struct.unpack_from("<B3xH2xI", read_data, 8)
+    return 32 + l_read_name + 4*n_cigar_op + (l_seq+1)//2 + l_seq
+
+def extract_tags_from_binary_read(read_data, ind_start = None):
+    # Typed tags in the order of read: list of (tag, type, value)
+    # Integers of any width have type 'i' as in SAM. Arrays ('B') have value (subtype, list of values).
+    if ind_start == None:
+        ind_start = get_start_index_of_tags_of_binary_read(read_data)
+    list_tags = list()
+    ind = ind_start
+    while ind < len(read_data):
+        tag = read_data[ind:ind+2].decode()
+        val_type = chr(read_data[ind+2])
+        ind += 3
+        if val_type == 'A':
+            list_tags.append((tag, 'A', chr(read_data[ind])))
+            ind += 1
+        elif val_type in _bam_tag_type:
+            value = struct.unpack_from(_bam_tag_type[val_type]["fmt"], read_data, ind)[0]
+            list_tags.append((tag, 'f' if val_type in "fd" else 'i', value))
+            ind += _bam_tag_type[val_type]["byte_len"]
+        elif val_type in "ZH":
+            ind_end = read_data.index(b'\x00', ind)
+            list_tags.append((tag, val_type, read_data[ind:ind_end].decode()))
+            ind = ind_end + 1
+        elif val_type == 'B':
+            sub_type = chr(read_data[ind])
+            val_length = struct.unpack_from("<I", read_data, ind+1)[0]
+            fmt_value = _bam_tag_type[sub_type]["fmt"]
+            value = list(struct.unpack_from(f"<{val_length}{fmt_value[1:]}", read_data, ind+5))
+            list_tags.append((tag, 'B', (sub_type, value)))
+            ind += 5 + val_length * _bam_tag_type[sub_type]["byte_len"]
+        else:
+            raise Exception(f"Wrong Datatype: {val_type}")
+    return list_tags
+
+def convert_tags_to_sam_string(list_tags):
+    # Output of extract_tags_from_binary_read -> "TG:t:value" fields joined by tab
+    list_str_tags = list()
+    for tag, val_type, value in list_tags:
+        if val_type == 'B':
+            sub_type, list_values = value
+            list_str_tags.append(','.join([f"{tag}:B:{sub_type}"] + list(map(lambda val: f"{val:g}" if sub_type == 'f' else str(val), list_values))))
+        elif val_type == 'f':
+            list_str_tags.append(f"{tag}:f:{value:g}")
+        else:
+            list_str_tags.append(f"{tag}:{val_type}:{value}")
+    return '\t'.join(list_str_tags)
+
 def extract_data_from_binary_bam_header(data):
     bam_magic = data[:4]
     assert bam_magic == b"BAM\x01", "BAM file does not start with BAM magic string. Maybe not a BAM file."
@@ -297,6 +380,54 @@ def extract_data_from_binary_bam_header(data):
         dict_refID[ind_ref] = {"name":name, "l_ref":l_ref}
     return text, dict_refID
         
+def get_length_of_binary_bam_header(data):
+    # Bytes of the BAM header. Raises struct.error if data is shorter than the header.
+    l_text = struct.unpack_from("<I", data, 4)[0]
+    n_ref = struct.unpack_from("<I", data, 8+l_text)[0]
+    curr_ind = l_text+12
+    for _ in range(n_ref):
+        l_name = struct.unpack_from("<I", data, curr_ind)[0]
+        struct.unpack_from("<I", data, curr_ind+4+l_name)
+        curr_ind += 8 + l_name
+    return curr_ind
+
+def get_binary_bam_header(plain_header_text, dict_refID):
+    # Inverse of extract_data_from_binary_bam_header
+    if isinstance(plain_header_text, str):
+        plain_header_text = plain_header_text.encode()
+    list_data = [b"BAM\x01", struct.pack("<I", len(plain_header_text)), plain_header_text, struct.pack("<I", len(dict_refID))]
+    for ind_ref in range(len(dict_refID)):
+        name = dict_refID[ind_ref]["name"].encode() + b"\x00"
+        list_data.append(struct.pack("<I", len(name)) + name + struct.pack("<I", dict_refID[ind_ref]["l_ref"]))
+    return b''.join(list_data)
+
+def get_bin_of_region(beg, end):
+    # "reg2bin" of SAM specification. beg: 0-based start, end: 0-based exclusive end
+    end -= 1
+    if beg >> 14 == end >> 14: return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17: return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20: return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23: return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26: return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+def get_bins_of_region(beg, end):
+    # "reg2bins" of SAM specification. List of bins which may contain reads overlapping [beg, end)
+    end -= 1
+    list_bins = [0]
+    for shift, offset in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        list_bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return list_bins
+
+def get_reference_end_of_read(read_data):
+    # 0-based exclusive end of the alignment on the reference, computed from the CIGAR of binary read data
+    pos, l_read_name, n_cigar_op = struct.unpack_from("<iB3xH", read_data, 4)
+    ref_len = 0
+    for cigar_op in struct.unpack_from(f"<{n_cigar_op}I", read_data, 32 + l_read_name):
+        if (cigar_op & 0xf) in (0, 2, 3, 7, 8): # M, D, N, =, X
+            ref_len += cigar_op >> 4
+    return pos + max(ref_len, 1)
+
 def get_parsed_data_and_end_index_of_binary_characters_until_null(data, ind_start):
     curr_ind = ind_start
     while 1:
@@ -346,12 +477,22 @@ def write_bam_header(path_save, header_data):
     file_handler.flush()
     file_handler.close()
             
-def read_block_data_from_offset(file_handler, coffset, ignore_checking = False):
+def read_block_data_from_offset(file_handler, coffset, ignore_checking = False, cache = None, stats = None):
+    # cache: BgzfBlockCache object (or any object with get(key) and put(key, data))
+    # Blocks are cached with the key (path of file, coffset). If the block is cached, the file handler does not move.
+    # stats: Optional dict (bam_stats.new_stats) to add I/O and inflation counters
+    if cache != None:
+        key_cache = (file_handler.name, coffset)
+        block_data = cache.get(key_cache)
+        if block_data != None:
+            return block_data
     file_handler.seek(coffset)
     if ignore_checking:
-        block_data = load_bgzf_block_compact(file_handler)
+        block_data = load_bgzf_block_compact(file_handler, stats = stats)
     else:
-        bsize, block_data = load_bgzf_block(file_handler)
+        bsize, block_data = load_bgzf_block(file_handler, stats = stats)
+    if cache != None:
+        cache.put(key_cache, block_data)
     return block_data
 
 def get_single_read_data_from_block_data(block_data, start_bytes):
@@ -359,11 +500,21 @@ def get_single_read_data_from_block_data(block_data, start_bytes):
     read_data = get_part_of_binary_string(block_data, ind_start=start_bytes, len_data = 4+block_size)
     return read_data
     
-def write_block(file_handler, data):
+def write_block(file_handler, data, stats = None, compresslevel = 6):
+    # stats: Optional dict (bam_stats.new_stats) to add compression and writing counters
     if isinstance(file_handler, str):
         file_handler = open(file_handler, "ab")
-    compressed_data = get_compressed_block_of_bam_data(data)
+    if stats is not None:
+        time_start = perf_counter()
+    compressed_data = get_compressed_block_of_bam_data(data, compresslevel)
+    if stats is not None:
+        time_write_start = perf_counter()
     file_handler.write(compressed_data)
+    if stats is not None:
+        stats["time_compress"] += time_write_start - time_start
+        stats["time_write"] += perf_counter() - time_write_start
+        stats["bytes_written"] += len(compressed_data)
+        stats["blocks_compressed"] += 1
     
 def write_eof(file_handler):
     if isinstance(file_handler, str):
@@ -0,0 +1,243 @@
+#%%
+from pathlib import Path
+import os, sys, io, json, argparse, platform, contextlib
+from time import perf_counter
+
+from joblib import Parallel, delayed
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_util import _size_max_block_data
+from bam_parallel_reader import *
+from sort_bam_with_pairedread import *
+
+_bases_4bit = np.array([1, 2, 4, 8], dtype = np.uint8) # A, C, G, T
+_bismark_xm_chars = np.frombuffer(b"..zZxXhH", dtype = np.uint8)
+
+def write_synthetic_bam(path_save, n_reads = 100000, read_length = 150, layout = "paired", tags = "bismark", span_blocks = False, n_refs = 3, l_ref = 10000000, seed = 0, write_gzi = True):
+    # Write a deterministic synthetic BAM (and its GZI) for benchmarks
+    #   layout "paired": Mates are adjacent with opposite TLEN (as Bismark output, and as BamPairSorter expects)
+    #   layout "single": Single-end reads
+    #   tags "bismark": NM, MD and Bismark-like XM / XR / XG tags. "none": No tags
+    #   span_blocks: Cut blocks at a fixed size regardless of read boundary, as samtools does.
+    #                BamPartReader expects reads not to span blocks, so record-level benchmarks are skipped for such files.
+    assert layout in ["paired", "single"], f"Unknown layout: {layout}"
+    assert tags in ["bismark", "none"], f"Unknown tag load: {tags}"
+    rng = np.random.default_rng(seed)
+
+    dict_refID = {ind_ref: {"name":f"chr{ind_ref+1}", "l_ref":l_ref} for ind_ref in range(n_refs)}
+    plain_header_text = "@HD\tVN:1.0\tSO:unsorted\n" + ''.join(f"@SQ\tSN:{dict_ref['name']}\tLN:{dict_ref['l_ref']}\n" for dict_ref in dict_refID.values())
+
+    list_coffset_of_block_start = list()
+    list_ucoffset_of_block_start = list()
+    file_writer = open(path_save, "wb")
+
+    def write_block_with_offsets(data, ucoffset):
+        list_coffset_of_block_start.append(file_writer.tell())
+        list_ucoffset_of_block_start.append(ucoffset)
+        write_block(file_writer, data)
+
+    header_data = get_binary_bam_header(plain_header_text, dict_refID)
+    write_block_with_offsets(header_data, 0)
+    ucoffset = len(header_data)
+
+    n_mates = 2 if layout == "paired" else 1
+    buffer = b''
+    for ind_read in range(0, n_reads, n_mates):
+        refID = int(rng.integers(n_refs))
+        pos = int(rng.integers(l_ref - 2*read_length))
+        tlen = int(rng.integers(read_length, 2*read_length))
+        is_reverse = bool(rng.integers(2))
+        for ind_mate in range(n_mates):
+            if layout == "paired":
+                mate_pos = pos + tlen - read_length if ind_mate == 0 else pos
+                this_pos = pos if ind_mate == 0 else pos + tlen - read_length
+                flag = 0x1 | 0x2 | (0x40 if ind_mate == 0 else 0x80) | ((0x10 if is_reverse else 0x20) if ind_mate == 0 else (0x20 if is_reverse else 0x10))
+                read_data = get_synthetic_read_data(rng, f"read{ind_read//2}", refID, this_pos, flag, read_length, refID, mate_pos, tlen if ind_mate == 0 else -tlen, tags, is_reverse ^ bool(ind_mate))
+            else:
+                flag = 0x10 if is_reverse else 0
+                read_data = get_synthetic_read_data(rng, f"read{ind_read}", refID, pos, flag, read_length, -1, -1, 0, tags, is_reverse)
+
+            if span_blocks:
+                buffer += read_data
+                while len(buffer) >= _size_max_block_data:
+                    write_block_with_offsets(buffer[:_size_max_block_data], ucoffset)
+                    ucoffset += _size_max_block_data
+                    buffer = buffer[_size_max_block_data:]
+            elif len(buffer) + len(read_data) > _size_max_block_data:
+                write_block_with_offsets(buffer, ucoffset)
+                ucoffset += len(buffer)
+                buffer = read_data
+            else:
+                buffer += read_data
+    if len(buffer) > 0:
+        write_block_with_offsets(buffer, ucoffset)
+    write_eof(file_writer)
+
+    if write_gzi:
+        write_bgzip_index(f"{path_save}.gzi", list_coffset_of_block_start, list_ucoffset_of_block_start)
+
+def get_synthetic_read_data(rng, read_name, refID, pos, flag, read_length, next_refID, next_pos, tlen, tags, is_reverse):
+    # Binary read data including the leading "block_size"
+    read_name = read_name.encode() + b"\x00"
+    cigar = struct.pack("<I", (read_length << 4) | 0) # {read_length}M
+    seq_4bit = _bases_4bit[rng.integers(4, size = read_length + read_length % 2)]
+    seq = ((seq_4bit[0::2] << 4) | seq_4bit[1::2]).tobytes()
+    qual = rng.integers(2, 41, size = read_length, dtype = np.uint8).tobytes()
+
+    tag_data = b''
+    if tags == "bismark":
+        xm = _bismark_xm_chars[rng.integers(len(_bismark_xm_chars), size = read_length)].tobytes()
+        xr = b"GA" if flag & 0x80 else b"CT"
+        xg = (b"CT" if xr == b"GA" else b"GA") if is_reverse else xr
+        tag_data = b"NMC" + struct.pack("<B", 0) + b"MDZ" + str(read_length).encode() + b"\x00" + b"XMZ" + xm + b"\x00" + b"XRZ" + xr + b"\x00" + b"XGZ" + xg + b"\x00"
+
+    read_fixed = struct.pack(
+        "<iiBBHHHIiii",
+        refID, pos, len(read_name), 40, get_bin_of_region(pos, pos+read_length), 1, flag, read_length, next_refID, next_pos, tlen
+    )
+    read_data = read_fixed + read_name + cigar + seq + qual + tag_data
+    return struct.pack("<I", len(read_data)) + read_data
+
+def count_reads_of_bam_reader(bam_reader):
+    bam_reader.set_file_handler()
+    n_reads = 0
+    for _ in bam_reader:
+        n_reads += 1
+    return n_reads, bam_reader.stats
+
+def time_function(func, repeat = 1):
+    # Returns the best (minimum) time of repeated runs and the result of the last run
+    list_elapsed = list()
+    for _ in range(repeat):
+        time_start = perf_counter()
+        result = func()
+        list_elapsed.append(perf_counter() - time_start)
+    return min(list_elapsed), result
+
+def run_benchmarks(path_bam, max_workers = 4, repeat = 3, span_blocks = False, layout = "paired"):
+    dict_results = dict()
+    size_bam = os.path.getsize(path_bam)
+
+    def add_result(name, elapsed, n_items = None, item_name = "reads"):
+        dict_results[name] = {"seconds":elapsed, "MB_per_second":size_bam / elapsed / 1e6 if elapsed > 0 else None}
+        if n_items != None:
+            dict_results[name][f"{item_name}_per_second"] = n_items / elapsed if elapsed > 0 else None
+
+    def load_header():
+        with open(path_bam, "rb") as handle:
+            bsize, header_data = load_bgzf_block(handle)
+        return extract_data_from_binary_bam_header(header_data)
+    elapsed, _ = time_function(load_header, repeat)
+    dict_results["header_parsing"] = {"seconds":elapsed}
+
+    for name, path_gzi in [("split_point_search_wo_gzi", None), ("split_point_search_with_gzi", f"{path_bam}.gzi")]:
+        def split_bam():
+            bpr = BAMParallelReader(path_bam, max_workers, path_gzi)
+            bpr.split_bgzip_bam_into_multiple_readers()
+        elapsed, _ = time_function(split_bam, repeat)
+        dict_results[name] = {"seconds":elapsed, "n_split":max_workers}
+
+    def inflate_blocks():
+        list_blocks = list()
+        with open(path_bam, "rb") as handle:
+            load_bgzf_block(handle)
+            while 1:
+                bsize, block_data = load_bgzf_block(handle)
+                if not block_data:
+                    break
+                list_blocks.append(block_data)
+        return list_blocks
+    elapsed, list_blocks = time_function(inflate_blocks, repeat)
+    add_result("block_inflation", elapsed, len(list_blocks), "blocks")
+
+    if span_blocks:
+        dict_results["skipped"] = "Reads span blocks, so record splitting, decoding, sorting and parallel scan are not measured"
+        return dict_results
+
+    def split_reads():
+        list_reads = list()
+        for block_data in list_blocks:
+            list_reads.extend(split_bgzf_block_into_reads(block_data))
+        return list_reads
+    elapsed, list_reads = time_function(split_reads, repeat)
+    add_result("record_splitting", elapsed, len(list_reads))
+
+    elapsed, _ = time_function(lambda: [extract_data_from_binary_read(read_data) for read_data in list_reads], 1)
+    add_result("full_decode", elapsed, len(list_reads))
+
+    if layout == "paired":
+        path_sorted = f"{path_bam}.benchmark_sorted.bam"
+        with contextlib.redirect_stdout(io.StringIO()):
+            bps = BamPairSorter(path_bam, max_workers)
+            elapsed_sort, _ = time_function(bps.run_sorting, 1)
+            elapsed_write, _ = time_function(lambda: bps.save_sorted_reads(path_sorted), 1)
+            bps.close_reader()
+        add_result("pair_sorter_scan_and_sort", elapsed_sort, len(list_reads))
+        add_result("pair_sorter_write", elapsed_write, len(list_reads))
+        dict_results["pair_sorter_stats"] = bps.stats
+        os.remove(path_sorted)
+
+    dict_results["parallel_scan"] = dict()
+    for n_workers in range(1, max_workers+1):
+        def scan_parallel():
+            bpr = BAMParallelReader(path_bam, n_workers)
+            bpr.split_bgzip_bam_into_multiple_readers()
+            with Parallel(n_jobs = n_workers) as parallel:
+                list_results = parallel(delayed(count_reads_of_bam_reader)(bam_reader) for bam_reader in bpr.list_splitted_bam_reader)
+            return sum([n_reads for n_reads, _ in list_results]), bpr.collect_stats([stats for _, stats in list_results])
+        elapsed, (n_reads, stats) = time_function(scan_parallel, repeat)
+        assert n_reads == len(list_reads), f"Parallel scan with {n_workers} workers read {n_reads} reads, not {len(list_reads)}"
+        dict_results["parallel_scan"][n_workers] = {"seconds":elapsed, "reads_per_second":n_reads / elapsed, "stats":stats}
+    n_workers_1 = dict_results["parallel_scan"][1]["seconds"]
+    for n_workers, dict_scan in dict_results["parallel_scan"].items():
+        dict_scan["speedup"] = n_workers_1 / dict_scan["seconds"]
+
+    return dict_results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark BAM Parallel Reader with synthetic BAM")
+    parser.add_argument("--out", default = "benchmark_results.json", help = "Path of JSON results")
+    parser.add_argument("--workdir", default = ".", help = "Directory for synthetic BAM")
+    parser.add_argument("--n-reads", type = int, default = 200000)
+    parser.add_argument("--read-length", type = int, default = 150)
+    parser.add_argument("--layout", choices = ["paired", "single"], default = "paired")
+    parser.add_argument("--tags", choices = ["bismark", "none"], default = "bismark")
+    parser.add_argument("--span-blocks", action = "store_true", help = "Let reads span BGZF blocks")
+    parser.add_argument("--max-workers", type = int, default = min(os.cpu_count(), 8))
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--keep-bam", action = "store_true", help = "Do not remove synthetic BAM after benchmarks")
+    args = parser.parse_args()
+
+    dict_config = vars(args).copy()
+    path_bam = os.path.join(args.workdir, f"synthetic.n{args.n_reads}.l{args.read_length}.{args.layout}.{args.tags}{'.span' if args.span_blocks else ''}.seed{args.seed}.bam")
+
+    print("Writing synthetic BAM...", flush = True)
+    elapsed_generate, _ = time_function(lambda: write_synthetic_bam(path_bam, args.n_reads, args.read_length, args.layout, args.tags, args.span_blocks, seed = args.seed), 1)
+
+    print("Running benchmarks...", flush = True)
+    dict_results = run_benchmarks(path_bam, args.max_workers, args.repeat, args.span_blocks, args.layout)
+
+    dict_output = {
+        "config" : dict_config,
+        "environment" : {
+            "python" : platform.python_version(),
+            "numpy" : np.__version__,
+            "platform" : platform.platform(),
+            "cpu_count" : os.cpu_count()
+        },
+        "bam" : {"path":path_bam, "bytes":os.path.getsize(path_bam), "seconds_to_generate":elapsed_generate},
+        "results" : dict_results
+    }
+    with open(args.out, "w") as file_writer:
+        json.dump(dict_output, file_writer, indent = 2)
+    print(f"Results saved: {args.out}", flush = True)
+
+    if not args.keep_bam:
+        os.remove(path_bam)
+        os.remove(f"{path_bam}.gzi")
+
+#%%
+if __name__ == "__main__":
+    main()
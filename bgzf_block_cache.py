@@ -0,0 +1,118 @@
+#%%
+from collections import OrderedDict
+import threading
+
+_cache_policies = ["lru", "clock"]
+
+class BgzfBlockCache():
+    # Cache of decompressed BGZF blocks, keyed by compressed offset (or (path, compressed offset) to share it between files)
+    # The size of cache is limited by the total bytes of decompressed blocks, not by the number of blocks
+    #   policy "lru": Evict the least recently used block
+    #   policy "clock": Evict the oldest block which was not used since the clock hand passed it (second chance)
+    #                   Hits only set the reference bit, so it is cheaper than "lru" on frequent hits
+    #   thread_safe: Lock every access. Necessary when the cache is shared between threads
+    # Entries can carry data other than the block (e.g. (block_data, compressed size)) with "n_bytes" given to put()
+    def __init__(self, max_bytes = 64 * 1024 * 1024, policy = "lru", thread_safe = False):
+        assert policy in _cache_policies, f"Cache policy must be one of {_cache_policies}"
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.thread_safe = thread_safe
+
+        self.__lock = threading.Lock() if thread_safe else None
+        # key -> [block_data, reference bit, bytes]
+        self.__blocks = OrderedDict()
+        self.curr_bytes = 0
+
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+    def get(self, key):
+        # Returns None if the block is not cached
+        if self.__lock != None:
+            with self.__lock:
+                return self.__get(key)
+        return self.__get(key)
+
+    def put(self, key, block_data, n_bytes = None):
+        # n_bytes: Bytes counted for the entry (len(block_data) by default)
+        if n_bytes == None:
+            n_bytes = len(block_data)
+        if self.__lock != None:
+            with self.__lock:
+                self.__put(key, block_data, n_bytes)
+        else:
+            self.__put(key, block_data, n_bytes)
+
+    def __get(self, key):
+        cached = self.__blocks.get(key)
+        if cached == None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        if self.policy == "lru":
+            self.__blocks.move_to_end(key)
+        else:
+            cached[1] = True
+        return cached[0]
+
+    def __put(self, key, block_data, n_bytes):
+        if n_bytes > self.max_bytes:
+            return
+        if key in self.__blocks:
+            self.curr_bytes -= self.__blocks.pop(key)[2]
+        while self.curr_bytes + n_bytes > self.max_bytes:
+            self.__evict()
+        self.__blocks[key] = [block_data, False, n_bytes]
+        self.curr_bytes += n_bytes
+
+    def __evict(self):
+        if self.policy == "clock":
+            # Front of the OrderedDict is the clock hand. Referenced blocks get a second chance.
+            while 1:
+                key, cached = next(iter(self.__blocks.items()))
+                if not cached[1]:
+                    break
+                cached[1] = False
+                self.__blocks.move_to_end(key)
+        _, cached = self.__blocks.popitem(last = False)
+        self.curr_bytes -= cached[2]
+        self.n_evictions += 1
+
+    def clear(self):
+        if self.__lock != None:
+            with self.__lock:
+                self.__clear()
+        else:
+            self.__clear()
+
+    def __clear(self):
+        # Blocks and their bytes are reset together, so that a concurrent put() sees a consistent size
+        self.__blocks.clear()
+        self.curr_bytes = 0
+
+    def __len__(self):
+        return len(self.__blocks)
+
+    def get_cache_stats(self):
+        n_access = self.n_hits + self.n_misses
+        return {
+            "n_blocks" : len(self.__blocks),
+            "bytes" : self.curr_bytes,
+            "max_bytes" : self.max_bytes,
+            "n_hits" : self.n_hits,
+            "n_misses" : self.n_misses,
+            "n_evictions" : self.n_evictions,
+            "hit_rate" : self.n_hits / n_access if n_access > 0 else 0.0
+        }
+
+    def __getstate__(self):
+        # Locks cannot be pickled (e.g. for joblib workers). The copy gets a new lock.
+        state = self.__dict__.copy()
+        state["_BgzfBlockCache__lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.thread_safe:
+            self.__lock = threading.Lock()
@@ -0,0 +1,94 @@
+#%%
+from pathlib import Path
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_util import _size_max_block_data
+
+class BgzfParallelWriter():
+    # BGZF writer compressing blocks in a thread pool (zlib releases the GIL) and writing them in order
+    #   n_threads: Number of compressing threads
+    #   max_pending_blocks: Blocks waiting to be written. Bounds the memory.
+    #   stats: Optional dict (bam_stats.new_stats) to add compression and writing counters
+    def __init__(self, path_save, n_threads = 4, compresslevel = 6, max_pending_blocks = None, stats = None):
+        self.path = path_save
+        self.n_threads = n_threads
+        self.compresslevel = compresslevel
+        self.max_pending_blocks = max_pending_blocks if max_pending_blocks != None else 4 * n_threads
+        self.stats = stats
+
+        self.file_handler = open(path_save, "wb")
+        self.__executor = ThreadPoolExecutor(max_workers = n_threads) if n_threads > 1 else None
+        self.__pending_blocks = deque()
+        self.__buffer = list()
+        self.__buffer_size = 0
+
+    def write_read(self, read_data):
+        # read_data: Read including the leading "block_size"
+        # Reads are not split between blocks (BamPartReader expects so), unless a single read is larger than a block
+        if self.__buffer_size + len(read_data) > _size_max_block_data:
+            self.flush_block()
+        if len(read_data) > _size_max_block_data:
+            self.write(read_data)
+            self.flush_block()
+            return
+        self.__buffer.append(read_data)
+        self.__buffer_size += len(read_data)
+
+    def write(self, data):
+        # Raw data, split into blocks at fixed size
+        self.__buffer.append(data)
+        self.__buffer_size += len(data)
+        if self.__buffer_size >= _size_max_block_data:
+            buffer = b''.join(self.__buffer)
+            ind_end = len(buffer) - len(buffer) % _size_max_block_data
+            for ind_start in range(0, ind_end, _size_max_block_data):
+                self.__submit_block(buffer[ind_start:ind_start+_size_max_block_data])
+            self.__buffer = [buffer[ind_end:]]
+            self.__buffer_size = len(buffer) - ind_end
+
+    def flush_block(self):
+        # Close the current block, so that the next data starts a new block
+        if self.__buffer_size > 0:
+            self.__submit_block(b''.join(self.__buffer))
+        self.__buffer = list()
+        self.__buffer_size = 0
+
+    def __submit_block(self, data):
+        if self.__executor == None:
+            write_block(self.file_handler, data, stats = self.stats, compresslevel = self.compresslevel)
+            return
+        self.__pending_blocks.append(self.__executor.submit(self.__compress_block, data))
+        while len(self.__pending_blocks) > self.max_pending_blocks:
+            self.__write_oldest_block()
+
+    def __compress_block(self, data):
+        time_start = perf_counter()
+        compressed_data = get_compressed_block_of_bam_data(data, self.compresslevel)
+        return compressed_data, perf_counter() - time_start
+
+    def __write_oldest_block(self):
+        compressed_data, time_compress = self.__pending_blocks.popleft().result()
+        time_write_start = perf_counter()
+        self.file_handler.write(compressed_data)
+        if self.stats is not None:
+            self.stats["time_compress"] += time_compress
+            self.stats["time_write"] += perf_counter() - time_write_start
+            self.stats["bytes_written"] += len(compressed_data)
+            self.stats["blocks_compressed"] += 1
+
+    def close(self, add_eof = True):
+        # add_eof: False for a part of BAM which will be concatenated with other parts
+        self.flush_block()
+        while len(self.__pending_blocks) > 0:
+            self.__write_oldest_block()
+        if self.__executor != None:
+            self.__executor.shutdown()
+        if add_eof:
+            write_eof(self.file_handler)
+        else:
+            self.file_handler.flush()
+            self.file_handler.close()
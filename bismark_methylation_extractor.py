@@ -0,0 +1,277 @@
+#%%
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_util import _cigar_op_str
+from bam_parallel_reader import *
+from bam_checkpoint import *
+
+# Bismark methylation call characters in the XM tag (upper case: methylated, lower case: unmethylated)
+_bismark_context_call = {
+    "CpG" : {"methylated":b"Z", "unmethylated":b"z"},
+    "CHG" : {"methylated":b"X", "unmethylated":b"x"},
+    "CHH" : {"methylated":b"H", "unmethylated":b"h"},
+}
+_bismark_no_call = ord('.')
+
+class BismarkMethylationExtractor():
+    # Count methylated / unmethylated calls per cytosine from the XM tags of Bismark BAM
+    #   n_reads_per_reduce: Raw calls of this number of reads are collapsed into the per-position counts of the shard, to bound memory
+    #   progress_callback: Called with the merged stats of the split readers at most once every "progress_interval" seconds
+    def __init__(self, path_file, parallel = 1, path_gzi = None, no_overlap = True, ignore_r1 = 0, ignore_r2 = 0, checkpoint_dir = None, n_reads_per_reduce = 20000, progress_callback = None, progress_interval = 10):
+        self.path = path_file
+        self.path_gzi = path_gzi
+        self.parallel = parallel
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+
+        self.no_overlap = no_overlap
+        self.ignore_r1 = ignore_r1
+        self.ignore_r2 = ignore_r2
+        self.n_reads_per_reduce = n_reads_per_reduce
+
+        self.plain_header_text = list()
+        self.dict_refID = dict()
+
+        self.dict_refID_to_methylation = dict()
+        
+        # Stats of the split readers (see bam_stats)
+        self.stats = dict()
+        
+        # Results of finished shards are kept in "checkpoint_dir", and reused when the extraction is run again after a crash.
+        # Removed when the extraction is completed.
+        self.checkpoint_dir = checkpoint_dir
+
+    def run_extraction(self):
+        print("Splitting BAM for parallelization...", flush = True)
+        bpr = BAMParallelReader(self.path, self.parallel, self.path_gzi, progress_callback = self.progress_callback, progress_interval = self.progress_interval)
+        bpr.split_bgzip_bam_into_multiple_readers()
+        self.plain_header_text = bpr.plain_header_text
+        self.dict_refID = bpr.dict_refID
+
+        print("Extracting methylation calls...", flush = True)
+        checkpoint_store = None
+        if self.checkpoint_dir != None:
+            dict_params = {"parallel":self.parallel, "path_gzi":self.path_gzi, "no_overlap":self.no_overlap, "ignore_r1":self.ignore_r1, "ignore_r2":self.ignore_r2}
+            checkpoint_store = CheckpointStore(self.checkpoint_dir, self.path, dict_params)
+        with bpr.report_progress():
+            list_shard_results = run_shards_with_checkpoint(
+                extract_methylation_calls_from_bam_reader,
+                [(bam_reader, self.no_overlap, self.ignore_r1, self.ignore_r2, self.n_reads_per_reduce) for bam_reader in bpr.list_splitted_bam_reader],
+                checkpoint_store,
+                self.parallel
+            )
+
+        print("Merging methylation calls of shards...", flush = True)
+        self.stats = bpr.collect_stats([shard_result["stats"] for shard_result in list_shard_results])
+        list_dict_calls = [shard_result["calls"] for shard_result in list_shard_results]
+        list_dict_calls.append(self.__get_methylation_calls_of_shard_boundary_reads(list_shard_results))
+        self.dict_refID_to_methylation = merge_methylation_calls(list_dict_calls)
+        if checkpoint_store != None:
+            checkpoint_store.clear()
+
+    def __get_methylation_calls_of_shard_boundary_reads(self, list_shard_results):
+        # Mates of a pair can be split into two neighboring shards.
+        # Each shard leaves its unpaired first and last reads, and they are paired here.
+        dict_calls = dict()
+        list_leftover_reads = list()
+        for shard_result in list_shard_results:
+            if shard_result["leading_read"] != None:
+                list_leftover_reads.append(shard_result["leading_read"])
+            if shard_result["trailing_read"] != None:
+                list_leftover_reads.append(shard_result["trailing_read"])
+
+        accumulate_methylation_calls_of_reads(dict_calls, list_leftover_reads, self.no_overlap, self.ignore_r1, self.ignore_r2)
+        return reduce_methylation_calls(dict_calls)
+
+    def save_coverage(self, path_save, context = "CpG"):
+        # Bismark coverage format: <chr> <start> <end> <methylation %> <count methylated> <count unmethylated> (1-based)
+        with open(path_save, "w") as file_writer:
+            for refID, ref_name, positions, n_meth, n_unmeth in self.__iterate_methylation_of_context(context):
+                perc_meth = 100 * n_meth / (n_meth + n_unmeth)
+                file_writer.write(''.join(
+                    f"{ref_name}\t{pos+1}\t{pos+1}\t{perc:g}\t{meth}\t{unmeth}\n"
+                    for pos, perc, meth, unmeth in zip(positions.tolist(), perc_meth.tolist(), n_meth.tolist(), n_unmeth.tolist())
+                ))
+
+    def save_bedgraph(self, path_save, context = "CpG"):
+        # bedGraph format: <chr> <start> <end> <methylation %> (0-based, half-open)
+        with open(path_save, "w") as file_writer:
+            file_writer.write("track type=bedGraph\n")
+            for refID, ref_name, positions, n_meth, n_unmeth in self.__iterate_methylation_of_context(context):
+                perc_meth = 100 * n_meth / (n_meth + n_unmeth)
+                file_writer.write(''.join(
+                    f"{ref_name}\t{pos}\t{pos+1}\t{perc:g}\n"
+                    for pos, perc in zip(positions.tolist(), perc_meth.tolist())
+                ))
+
+    def __iterate_methylation_of_context(self, context):
+        assert context in _bismark_context_call, f"Unknown methylation context: {context}"
+        for refID in sorted(self.dict_refID_to_methylation.keys()):
+            if context not in self.dict_refID_to_methylation[refID]:
+                continue
+            positions, n_meth, n_unmeth = self.dict_refID_to_methylation[refID][context]
+            yield refID, self.dict_refID[refID]["name"], positions, n_meth, n_unmeth
+
+def extract_methylation_calls_from_bam_reader(bam_reader, no_overlap = True, ignore_r1 = 0, ignore_r2 = 0, n_reads_per_reduce = 20000):
+    # Worker for a single BamPartReader shard.
+    # Mates are expected to be adjacent (Bismark output), so the reads are processed pair by pair.
+    # Unpaired reads at both ends of the shard are returned as raw data, because their mates can be in the neighboring shards.
+    # Raw calls are folded into the per-position counts every "n_reads_per_reduce" reads, so only the counts are kept for the whole shard.
+    bam_reader.set_file_handler()
+
+    dict_counts = dict()
+    dict_calls = dict()
+    n_reads_not_reduced = 0
+    leading_read = None
+    pending_read = None
+    is_first_read = True
+    for read_data in bam_reader:
+        if pending_read == None:
+            pending_read = read_data
+            continue
+        if is_pair_of_adjacent_reads(pending_read, read_data):
+            accumulate_methylation_calls_of_reads(dict_calls, [pending_read, read_data], no_overlap, ignore_r1, ignore_r2)
+            pending_read = None
+        elif is_first_read:
+            leading_read = pending_read
+            pending_read = read_data
+        else:
+            accumulate_methylation_calls_of_reads(dict_calls, [pending_read], no_overlap, ignore_r1, ignore_r2)
+            pending_read = read_data
+        is_first_read = False
+
+        n_reads_not_reduced += 1
+        if n_reads_not_reduced >= n_reads_per_reduce:
+            dict_counts = merge_methylation_calls([dict_counts, reduce_methylation_calls(dict_calls)])
+            dict_calls = dict()
+            n_reads_not_reduced = 0
+
+    return {
+        "calls" : merge_methylation_calls([dict_counts, reduce_methylation_calls(dict_calls)]),
+        "leading_read" : leading_read,
+        "trailing_read" : pending_read,
+        "stats" : bam_reader.stats
+    }
+
+def is_pair_of_adjacent_reads(read_data_1, read_data_2):
+    flag_1 = struct.unpack("<H", read_data_1[14:16])[0]
+    if flag_1 & 1 == 0:
+        return False
+    return extract_readid_from_binary_read(read_data_1) == extract_readid_from_binary_read(read_data_2)
+
+def accumulate_methylation_calls_of_reads(dict_calls, list_reads_data, no_overlap = True, ignore_r1 = 0, ignore_r2 = 0):
+    # list_reads_data: reads to process. Adjacent reads with the same read name are treated as mates.
+    ind = 0
+    while ind < len(list_reads_data):
+        dict_read = extract_data_from_binary_read(list_reads_data[ind])
+        dict_mate = None
+        if ind+1 < len(list_reads_data) and is_pair_of_adjacent_reads(list_reads_data[ind], list_reads_data[ind+1]):
+            dict_mate = extract_data_from_binary_read(list_reads_data[ind+1])
+            ind += 2
+        else:
+            ind += 1
+
+        if dict_mate == None:
+            add_methylation_calls_of_read(dict_calls, dict_read, ignore_r1 if dict_read["flag"] & 0x80 == 0 else ignore_r2)
+            continue
+
+        dict_read1, dict_read2 = (dict_read, dict_mate) if dict_mate["flag"] & 0x80 else (dict_mate, dict_read)
+        read1_ref_range = add_methylation_calls_of_read(dict_calls, dict_read1, ignore_r1)
+        if no_overlap and read1_ref_range != None and dict_read1["refID"] == dict_read2["refID"]:
+            # Calls of read 2 overlapping with read 1 are not counted (same as "--no_overlap" of Bismark)
+            add_methylation_calls_of_read(dict_calls, dict_read2, ignore_r2, read1_ref_range)
+        else:
+            add_methylation_calls_of_read(dict_calls, dict_read2, ignore_r2)
+
+def add_methylation_calls_of_read(dict_calls, dict_read, ignore_5prime = 0, exclude_ref_range = None):
+    # Returns the reference range [start, end) covered by the read, or None if the read has no methylation call
+    if dict_read["flag"] & 0x4 or dict_read["refID"] < 0:
+        return None
+    if "XM" not in dict_read:
+        return None
+
+    ref_positions, ref_end = get_reference_positions_of_read(dict_read["pos"], dict_read["cigar"], dict_read["l_seq"])
+    calls = np.frombuffer(dict_read["XM"], dtype = np.uint8)
+
+    is_valid_call = (calls != _bismark_no_call) & (ref_positions >= 0)
+    if ignore_5prime > 0:
+        # Bismark stores XM along the forward strand of the genome.
+        # The read was reverse complemented when XR and XG conversions differ, so its 5' end is at the end of XM.
+        if dict_read.get("XR") != dict_read.get("XG"):
+            is_valid_call[max(len(calls)-ignore_5prime, 0):] = False
+        else:
+            is_valid_call[:ignore_5prime] = False
+    if exclude_ref_range != None:
+        is_valid_call &= (ref_positions < exclude_ref_range[0]) | (ref_positions >= exclude_ref_range[1])
+
+    if dict_calls.get(dict_read["refID"]) == None:
+        dict_calls[dict_read["refID"]] = {"positions":list(), "calls":list()}
+    dict_calls[dict_read["refID"]]["positions"].append(ref_positions[is_valid_call])
+    dict_calls[dict_read["refID"]]["calls"].append(calls[is_valid_call])
+
+    return dict_read["pos"], ref_end
+
+def get_reference_positions_of_read(pos, list_cigar, l_seq):
+    # Map each base of the read to the 0-based reference coordinate. Inserted or soft-clipped bases get -1.
+    ref_positions = np.full(l_seq, -1, dtype = np.int64)
+    ind_query = 0
+    ind_ref = pos
+    for cigar_op in list_cigar:
+        op_len = cigar_op >> 4
+        op = cigar_op ^ (op_len << 4)
+        op_str = _cigar_op_str[op]
+        if op_str in "M=X":
+            ref_positions[ind_query:ind_query+op_len] = np.arange(ind_ref, ind_ref+op_len)
+            ind_query += op_len
+            ind_ref += op_len
+        elif op_str in "IS":
+            ind_query += op_len
+        elif op_str in "DN":
+            ind_ref += op_len
+    return ref_positions, ind_ref
+
+def reduce_methylation_calls(dict_calls):
+    # Collapse raw calls into counts per position.
+    # Returns {refID: {context: (positions, n_methylated, n_unmethylated)}}
+    dict_reduced = dict()
+    for refID, dict_calls_ref in dict_calls.items():
+        if len(dict_calls_ref["positions"]) == 0:
+            continue
+        positions = np.concatenate(dict_calls_ref["positions"])
+        calls = np.concatenate(dict_calls_ref["calls"])
+        dict_reduced[refID] = dict()
+        for context, dict_call_char in _bismark_context_call.items():
+            is_meth = calls == ord(dict_call_char["methylated"])
+            is_context = is_meth | (calls == ord(dict_call_char["unmethylated"]))
+            if not is_context.any():
+                continue
+            dict_reduced[refID][context] = count_methylation_per_position(positions[is_context], is_meth[is_context].astype(np.int64), np.ones(is_context.sum(), dtype = np.int64))
+    return dict_reduced
+
+def count_methylation_per_position(positions, n_meth, n_total):
+    uniq_positions, ind_inverse = np.unique(positions, return_inverse = True)
+    n_meth_per_position = np.bincount(ind_inverse, weights = n_meth, minlength = len(uniq_positions)).astype(np.int64)
+    n_total_per_position = np.bincount(ind_inverse, weights = n_total, minlength = len(uniq_positions)).astype(np.int64)
+    return uniq_positions, n_meth_per_position, n_total_per_position - n_meth_per_position
+
+def merge_methylation_calls(list_dict_calls):
+    # Merge the per-position counts of multiple shards
+    dict_merged = dict()
+    set_refID = set()
+    for dict_calls in list_dict_calls:
+        set_refID.update(dict_calls.keys())
+
+    for refID in set_refID:
+        dict_merged[refID] = dict()
+        for context in _bismark_context_call.keys():
+            list_counts = [dict_calls[refID][context] for dict_calls in list_dict_calls if context in dict_calls.get(refID, {})]
+            if len(list_counts) == 0:
+                continue
+            positions = np.concatenate([counts[0] for counts in list_counts])
+            n_meth = np.concatenate([counts[1] for counts in list_counts])
+            n_unmeth = np.concatenate([counts[2] for counts in list_counts])
+            dict_merged[refID][context] = count_methylation_per_position(positions, n_meth, n_meth + n_unmeth)
+    return dict_merged
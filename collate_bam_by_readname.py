@@ -0,0 +1,228 @@
+#%%
+from pathlib import Path
+import os, sys, subprocess
+
+from joblib import Parallel, delayed
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_util import _size_max_block_data
+from bam_parallel_reader import *
+from bam_region_query import find_bai_path, generate_reads_from_virtual_offset
+from read_bai import read_bai
+from bam_stats import *
+
+_max_depth_resplit = 4
+
+class BamReadCollator():
+    # Group the reads by read name (mates next to each other), without sorting by name.
+    # Works for any input order, e.g. coordinate-sorted BAM, which BamPairSorter does not accept.
+    #   1st pass (parallel per split of BAM): Hash read names into "n_buckets" temporary BGZF files (compression level 1)
+    #   2nd pass (parallel per bucket): Group the reads of each bucket in memory
+    #   max_memory: Bytes of reads held in memory by all workers of the 2nd pass.
+    #               Buckets larger than (max_memory / parallel) are split again into sub-buckets.
+    def __init__(self, path_file, parallel = 1, n_buckets = 64, max_memory = 4 * 1024**3, path_gzi = None, path_bai = None):
+        self.path = path_file
+        self.parallel = parallel
+        self.n_buckets = n_buckets
+        self.max_memory = max_memory
+        self.path_gzi = path_gzi
+        self.path_bai = path_bai
+
+        self.plain_header_text = list()
+        self.dict_refID = dict()
+        self.stats = dict()
+
+    def run_collation(self, path_save):
+        print("Splitting BAM for parallelization...", flush = True)
+        list_voffset_ranges = self.__get_virtual_offset_ranges_for_parallelizing()
+
+        print("Hashing reads into buckets...", flush = True)
+        list_list_path_buckets = [[f"{path_save}.__tmp.split{ind_split}.bucket{ind_bucket}" for ind_bucket in range(self.n_buckets)] for ind_split in range(len(list_voffset_ranges))]
+        with Parallel(n_jobs = self.parallel) as parallel:
+            list_hash_results = parallel(delayed(write_reads_into_buckets)(
+                self.path,
+                voffset_start,
+                voffset_end,
+                list_list_path_buckets[ind_split]
+            ) for ind_split, (voffset_start, voffset_end) in enumerate(list_voffset_ranges))
+        self.stats["hash"] = merge_stats([hash_result["stats"] for hash_result in list_hash_results])
+
+        print("Grouping reads by read name...", flush = True)
+        time_collate_start = perf_counter()
+        list_bytes_per_bucket = [sum(hash_result["bytes_per_bucket"][ind_bucket] for hash_result in list_hash_results) for ind_bucket in range(self.n_buckets)]
+        list_path_collated = [f"{path_save}.__tmp.bucket{ind_bucket}" for ind_bucket in range(self.n_buckets)]
+        with Parallel(n_jobs = self.parallel) as parallel:
+            list_collate_results = parallel(delayed(collate_reads_of_bucket)(
+                [list_path_buckets[ind_bucket] for list_path_buckets in list_list_path_buckets],
+                list_path_collated[ind_bucket],
+                list_bytes_per_bucket[ind_bucket],
+                self.max_memory // self.parallel,
+                self.n_buckets
+            ) for ind_bucket in range(self.n_buckets))
+        # There are more buckets than processes, so the elapsed time is the wall time of all buckets
+        self.stats["collate"] = set_time_elapsed(merge_stats([collate_result["stats"] for collate_result in list_collate_results]), perf_counter() - time_collate_start)
+        self.stats["n_read_names"] = sum(collate_result["n_read_names"] for collate_result in list_collate_results)
+        self.stats["n_unpaired_read_names"] = sum(collate_result["n_unpaired_read_names"] for collate_result in list_collate_results)
+        self.stats["n_resplit_buckets"] = sum(collate_result["n_resplit_buckets"] for collate_result in list_collate_results)
+
+        print("Save collated reads...", flush = True)
+        path_save_header = f"{path_save}.__tmp.header"
+        write_bam_header(path_save_header, get_binary_bam_header(get_collated_header_text(self.plain_header_text), self.dict_refID))
+        list_files_concat = [path_save_header] + list_path_collated
+        subprocess.run(f"cat {' '.join(list_files_concat)} > {path_save}", shell = True)
+        [os.remove(path_tmp) for path_tmp in list_files_concat]
+        write_eof(path_save)
+
+    def __get_virtual_offset_ranges_for_parallelizing(self):
+        # With BAI, the linear index gives virtual offsets where reads start, so reads spanning blocks are safe.
+        # Without BAI, the BAM is split at blocks by BAMParallelReader, which expects reads not to span blocks.
+        bpr = BAMParallelReader(self.path, self.parallel, self.path_gzi)
+        bpr.split_bgzip_bam_into_multiple_readers()
+        self.plain_header_text = bpr.plain_header_text
+        self.dict_refID = bpr.dict_refID
+        list_voffset_ranges = [(make_virtual_offset_from_bytes(bam_reader.bstart), make_virtual_offset_from_bytes(bam_reader.bend)) for bam_reader in bpr.list_splitted_bam_reader]
+
+        path_bai = self.path_bai
+        if path_bai == None:
+            try:
+                path_bai = find_bai_path(self.path)
+            except FileNotFoundError:
+                return list_voffset_ranges
+
+        dict_bai = read_bai(path_bai)
+        list_voffsets = sorted(set(ioffset for dict_bai_ref in dict_bai.values() for ioffset in dict_bai_ref["intervals"].values() if ioffset > 0))
+        if len(list_voffsets) < self.parallel:
+            return list_voffset_ranges
+        voffset_first = list_voffset_ranges[0][0]
+        list_voffset_starts = [voffset_first] + [list_voffsets[int(ind)] for ind in np.linspace(0, len(list_voffsets), self.parallel+1)[1:-1]]
+        list_voffset_starts = sorted(set(voffset for voffset in list_voffset_starts if voffset >= voffset_first))
+        return list(zip(list_voffset_starts, list_voffset_starts[1:] + [None]))
+
+def get_collated_header_text(plain_header_text):
+    # Set "SO:unsorted" and "GO:query" on the @HD line
+    if isinstance(plain_header_text, bytes):
+        plain_header_text = plain_header_text.decode()
+    list_lines = plain_header_text.strip('\x00').split('\n')
+    if list_lines[0].startswith("@HD"):
+        list_fields = [field for field in list_lines[0].split('\t') if not field.startswith("SO:") and not field.startswith("GO:")]
+        list_lines[0] = '\t'.join(list_fields + ["SO:unsorted", "GO:query"])
+    else:
+        list_lines.insert(0, "@HD\tVN:1.6\tSO:unsorted\tGO:query")
+    return '\n'.join(list_lines)
+
+def get_bucket_of_read_binary_data(read_data, n_buckets, depth = 0):
+    # Buckets split again (depth > 0) use the higher digits of the hash, so that their reads are spread over sub-buckets
+    l_read_name = read_data[8]
+    return (zlib.crc32(read_data[32:32+l_read_name]) // n_buckets**depth) % n_buckets
+
+def write_reads_into_buckets(path_bam, voffset_start, voffset_end, list_path_buckets, depth = 0):
+    # Write raw reads (with "block_size") into the bucket files of their read names
+    # Returns the uncompressed bytes per bucket and the stats
+    time_start = perf_counter()
+    stats = new_stats()
+    n_buckets = len(list_path_buckets)
+    list_file_writers = [open(path_bucket, "wb") for path_bucket in list_path_buckets]
+    list_buffers = [list() for _ in range(n_buckets)]
+    list_buffer_size = [0] * n_buckets
+    list_bytes_per_bucket = [0] * n_buckets
+
+    def flush_bucket(ind_bucket):
+        write_block(list_file_writers[ind_bucket], b''.join(list_buffers[ind_bucket]), stats = stats, compresslevel = 1)
+        list_buffers[ind_bucket] = list()
+        list_buffer_size[ind_bucket] = 0
+
+    with open(path_bam, "rb") as file_reader:
+        for _, read_data in generate_reads_from_virtual_offset(file_reader, voffset_start, voffset_end, stats = stats):
+            ind_bucket = get_bucket_of_read_binary_data(read_data, n_buckets, depth)
+            read_data = struct.pack("<I", len(read_data)) + read_data
+            if list_buffer_size[ind_bucket] + len(read_data) > _size_max_block_data:
+                flush_bucket(ind_bucket)
+            list_buffers[ind_bucket].append(read_data)
+            list_buffer_size[ind_bucket] += len(read_data)
+            list_bytes_per_bucket[ind_bucket] += len(read_data)
+            stats["reads_emitted"] += 1
+
+    for ind_bucket in range(n_buckets):
+        if list_buffer_size[ind_bucket] > 0:
+            flush_bucket(ind_bucket)
+        list_file_writers[ind_bucket].close()
+    stats["time_elapsed"] = perf_counter() - time_start
+    return {"bytes_per_bucket":list_bytes_per_bucket, "stats":stats}
+
+def collate_reads_of_bucket(list_path_bucket_files, path_save, bytes_bucket, max_memory, n_buckets, depth = 0):
+    # Group reads of a bucket by read name, and write them (without EOF) to path_save.
+    # Mates are written as read 1, read 2, then secondary / supplementary alignments.
+    # The bucket files are removed after grouping.
+    time_start = perf_counter()
+    dict_result = {"n_read_names":0, "n_unpaired_read_names":0, "n_resplit_buckets":0, "stats":new_stats()}
+    if bytes_bucket > max_memory and depth < _max_depth_resplit and n_buckets**(depth+1) < 2**32:
+        # Too large to group in memory. Split the bucket again, then group each of them.
+        list_path_sub_buckets = [f"{path_save}.sub{depth}.bucket{ind_bucket}" for ind_bucket in range(n_buckets)]
+        list_bytes_per_sub_bucket = [0] * n_buckets
+        list_list_path_sub_buckets = list()
+        for ind_file, path_bucket_file in enumerate(list_path_bucket_files):
+            list_path_sub_buckets_of_file = [f"{path_sub_bucket}.{ind_file}" for path_sub_bucket in list_path_sub_buckets]
+            hash_result = write_reads_into_buckets(path_bucket_file, 0, None, list_path_sub_buckets_of_file, depth = depth + 1)
+            list_bytes_per_sub_bucket = [n_bytes + n_bytes_file for n_bytes, n_bytes_file in zip(list_bytes_per_sub_bucket, hash_result["bytes_per_bucket"])]
+            list_list_path_sub_buckets.append(list_path_sub_buckets_of_file)
+            os.remove(path_bucket_file)
+
+        list_path_collated = [f"{path_sub_bucket}.collated" for path_sub_bucket in list_path_sub_buckets]
+        list_sub_stats = list()
+        for ind_bucket in range(n_buckets):
+            sub_result = collate_reads_of_bucket(
+                [list_path_sub_buckets_of_file[ind_bucket] for list_path_sub_buckets_of_file in list_list_path_sub_buckets],
+                list_path_collated[ind_bucket],
+                list_bytes_per_sub_bucket[ind_bucket],
+                max_memory,
+                n_buckets,
+                depth + 1
+            )
+            for key in ["n_read_names", "n_unpaired_read_names", "n_resplit_buckets"]:
+                dict_result[key] += sub_result[key]
+            list_sub_stats.append(sub_result["stats"])
+        dict_result["n_resplit_buckets"] += 1
+        subprocess.run(f"cat {' '.join(list_path_collated)} > {path_save}", shell = True)
+        [os.remove(path_tmp) for path_tmp in list_path_collated]
+        # Sub-buckets are collated one after another
+        dict_result["stats"] = set_time_elapsed(merge_stats(list_sub_stats), perf_counter() - time_start)
+        return dict_result
+
+    stats = dict_result["stats"]
+    dict_readname_to_reads = dict()
+    for path_bucket_file in list_path_bucket_files:
+        with open(path_bucket_file, "rb") as file_reader:
+            for _, read_data in generate_reads_from_virtual_offset(file_reader, 0, stats = stats):
+                read_name = read_data[32:32+read_data[8]]
+                if read_name not in dict_readname_to_reads:
+                    dict_readname_to_reads[read_name] = list()
+                dict_readname_to_reads[read_name].append(read_data)
+        os.remove(path_bucket_file)
+
+    with open(path_save, "wb") as file_writer:
+        buffer = list()
+        buffer_size = 0
+        for list_reads_data in dict_readname_to_reads.values():
+            if len(list_reads_data) == 1:
+                dict_result["n_unpaired_read_names"] += 1
+            list_reads_data.sort(key = get_collate_order_of_read_binary_data)
+            for read_data in list_reads_data:
+                read_data = struct.pack("<I", len(read_data)) + read_data
+                if buffer_size + len(read_data) > _size_max_block_data:
+                    write_block(file_writer, b''.join(buffer), stats = stats)
+                    buffer = list()
+                    buffer_size = 0
+                buffer.append(read_data)
+                buffer_size += len(read_data)
+                stats["reads_emitted"] += 1
+        if buffer_size > 0:
+            write_block(file_writer, b''.join(buffer), stats = stats)
+    dict_result["n_read_names"] = len(dict_readname_to_reads)
+    stats["time_elapsed"] = perf_counter() - time_start
+    return dict_result
+
+def get_collate_order_of_read_binary_data(read_data):
+    # Primary alignments first (read 1, then read 2), then secondary / supplementary alignments
+    flag = struct.unpack_from("<H", read_data, 14)[0]
+    return (flag & 0x900 != 0, flag & 0x80 != 0)
@@ -0,0 +1,193 @@
+#%%
+from pathlib import Path
+import os, sys, heapq, subprocess
+
+from joblib import Parallel, delayed
+
+sys.path.append(str(Path(__file__).parents[0]))
+from bam_util import *
+from bam_region_query import *
+from bgzf_parallel_writer import BgzfParallelWriter
+from bam_stats import *
+
+_key_unmapped = 2**31 # refID of unmapped reads (-1) is sorted last
+
+class BamSortedMerger():
+    # Merge coordinate-sorted BAMs (e.g. per lane) into a single coordinate-sorted BAM
+    # Reads are compared by (refID, pos) of the fixed part of the record, without decoding.
+    #   parallel: With BAI of every input, each reference is merged by a separate worker and the parts are concatenated in order.
+    #             Otherwise, all inputs are merged by a single heap.
+    #   n_threads: Compressing threads of the writer of each worker
+    def __init__(self, list_path_files, parallel = 1, n_threads = 4, compresslevel = 6):
+        assert len(list_path_files) > 0, "No BAM to merge"
+        self.list_path = list_path_files
+        self.parallel = parallel
+        self.n_threads = n_threads
+        self.compresslevel = compresslevel
+
+        self.plain_header_text = None
+        self.dict_refID = dict()
+        # Per input: list of merged refID of each refID of the input
+        self.list_refID_maps = list()
+        self.stats = dict()
+
+    def run_merge(self, path_save):
+        print("Reconciling BAM headers...", flush = True)
+        self.__reconcile_headers()
+
+        list_dict_bai = self.__read_bai_of_inputs()
+        if self.parallel > 1 and list_dict_bai != None:
+            print("Merging BAMs per reference...", flush = True)
+            self.__merge_per_reference(path_save, list_dict_bai)
+        else:
+            print("Merging BAMs...", flush = True)
+            path_save_header = f"{path_save}.__tmp.header"
+            self.__write_header(path_save_header)
+            list_voffset_ranges = [(self.__get_first_read_virtual_offset(path_bam), None) for path_bam in self.list_path]
+            path_save_reads = f"{path_save}.__tmp.reads"
+            stats = merge_reads_of_sorted_bams(self.list_path, list_voffset_ranges, self.list_refID_maps, path_save_reads, None, self.n_threads, self.compresslevel)
+            self.stats["merge"] = merge_stats([stats])
+            self.__concat_files([path_save_header, path_save_reads], path_save)
+
+    def __reconcile_headers(self):
+        # References with the same name must have the same length.
+        # References not in the first BAM are appended, and every BAM must keep its reference order in the merged header.
+        list_headers = list()
+        dict_name_to_merged_refID = dict()
+        for path_bam in self.list_path:
+            with open(path_bam, "rb") as file_reader:
+                _, plain_header_text, dict_refID = read_bam_header(file_reader)
+            list_headers.append(plain_header_text.strip(b'\x00').decode())
+
+            list_refID_map = list()
+            for refID in range(len(dict_refID)):
+                name = dict_refID[refID]["name"]
+                if name not in dict_name_to_merged_refID:
+                    dict_name_to_merged_refID[name] = len(self.dict_refID)
+                    self.dict_refID[len(self.dict_refID)] = dict(dict_refID[refID])
+                merged_refID = dict_name_to_merged_refID[name]
+                assert self.dict_refID[merged_refID]["l_ref"] == dict_refID[refID]["l_ref"], f"Length of reference {name} differs in {path_bam}"
+                list_refID_map.append(merged_refID)
+            assert list_refID_map == sorted(list_refID_map), f"Order of references in {path_bam} is not compatible with the other BAMs"
+            self.list_refID_maps.append(list_refID_map)
+
+        self.plain_header_text = get_merged_header_text(list_headers, self.dict_refID)
+
+    def __read_bai_of_inputs(self):
+        # None if any input has no BAI
+        list_dict_bai = list()
+        for path_bam in self.list_path:
+            try:
+                list_dict_bai.append(read_bai(find_bai_path(path_bam)))
+            except FileNotFoundError:
+                return None
+        return list_dict_bai
+
+    def __get_first_read_virtual_offset(self, path_bam):
+        with open(path_bam, "rb") as file_reader:
+            return get_virtual_offset_after_header(file_reader)
+
+    def __merge_per_reference(self, path_save, list_dict_bai):
+        # Jobs: every merged refID with reads, then unmapped reads
+        list_list_voffset_ranges = list()
+        for merged_refID in range(len(self.dict_refID)):
+            list_voffset_ranges = list()
+            for ind_bam, dict_bai in enumerate(list_dict_bai):
+                refID = self.list_refID_maps[ind_bam].index(merged_refID) if merged_refID in self.list_refID_maps[ind_bam] else None
+                voffset_range = get_virtual_offset_range_of_reference(dict_bai, refID) if refID != None else None
+                list_voffset_ranges.append(voffset_range)
+            if any(voffset_range != None for voffset_range in list_voffset_ranges):
+                list_list_voffset_ranges.append((merged_refID, list_voffset_ranges))
+
+        list_voffset_ranges_unmapped = list()
+        for ind_bam, (path_bam, dict_bai) in enumerate(zip(self.list_path, list_dict_bai)):
+            list_voffset_ends = [voffset_range[1] for voffset_range in map(lambda refID: get_virtual_offset_range_of_reference(dict_bai, refID), dict_bai.keys()) if voffset_range != None]
+            voffset_start = max(list_voffset_ends) if len(list_voffset_ends) > 0 else self.__get_first_read_virtual_offset(path_bam)
+            list_voffset_ranges_unmapped.append((voffset_start, None))
+        list_list_voffset_ranges.append((-1, list_voffset_ranges_unmapped))
+
+        path_save_header = f"{path_save}.__tmp.header"
+        self.__write_header(path_save_header)
+        list_path_parts = [f"{path_save}.__tmp.refID{merged_refID}" for merged_refID, _ in list_list_voffset_ranges]
+        with Parallel(n_jobs = self.parallel) as parallel:
+            list_stats = parallel(delayed(merge_reads_of_sorted_bams)(
+                self.list_path,
+                list_voffset_ranges,
+                self.list_refID_maps,
+                path_save_part,
+                merged_refID,
+                self.n_threads,
+                self.compresslevel
+            ) for (merged_refID, list_voffset_ranges), path_save_part in zip(list_list_voffset_ranges, list_path_parts))
+        self.stats["merge"] = merge_stats(list_stats)
+        self.__concat_files([path_save_header] + list_path_parts, path_save)
+
+    def __write_header(self, path_save_header):
+        writer = BgzfParallelWriter(path_save_header, n_threads = 1, compresslevel = self.compresslevel)
+        writer.write(get_binary_bam_header(self.plain_header_text, self.dict_refID))
+        writer.close(add_eof = False)
+
+    def __concat_files(self, list_files_concat, path_save):
+        subprocess.run(f"cat {' '.join(list_files_concat)} > {path_save}", shell = True)
+        [os.remove(path_tmp) for path_tmp in list_files_concat]
+        write_eof(path_save)
+
+def get_merged_header_text(list_headers, dict_refID):
+    # Header lines of the first BAM, with @SQ lines of the merged references and @RG / @PG / @CO lines of the other BAMs
+    list_lines = [line for line in list_headers[0].split('\n') if line != '' and not line.startswith("@SQ")]
+    if len(list_lines) > 0 and list_lines[0].startswith("@HD"):
+        list_lines[0] = '\t'.join([field for field in list_lines[0].split('\t') if not field.startswith("SO:")] + ["SO:coordinate"])
+    else:
+        list_lines.insert(0, "@HD\tVN:1.6\tSO:coordinate")
+    list_sq_lines = [f"@SQ\tSN:{dict_refID[refID]['name']}\tLN:{dict_refID[refID]['l_ref']}" for refID in range(len(dict_refID))]
+    list_lines = list_lines[:1] + list_sq_lines + list_lines[1:]
+    for plain_header_text in list_headers[1:]:
+        for line in plain_header_text.split('\n'):
+            if line[:3] in ("@RG", "@PG", "@CO") and line not in list_lines:
+                list_lines.append(line)
+    return '\n'.join(list_lines) + '\n'
+
+def remap_refID_on_read_binary_data(read_data, list_refID_map):
+    # Rewrite refID and next_refID to the merged refIDs
+    refID = struct.unpack_from("<i", read_data, 0)[0]
+    next_refID = struct.unpack_from("<i", read_data, 20)[0]
+    merged_refID = list_refID_map[refID] if refID >= 0 else -1
+    merged_next_refID = list_refID_map[next_refID] if next_refID >= 0 else -1
+    if merged_refID == refID and merged_next_refID == next_refID:
+        return read_data
+    return struct.pack("<i", merged_refID) + read_data[4:20] + struct.pack("<i", merged_next_refID) + read_data[24:]
+
+def generate_sort_key_and_reads(path_bam, voffset_range, list_refID_map, merged_refID_only = None):
+    # Yield ((merged refID, pos), read data with "block_size") of a sorted BAM
+    # merged_refID_only: Stop at the first read of another reference (-1: unmapped reads)
+    is_identity_map = list_refID_map == list(range(len(list_refID_map)))
+    voffset_start, voffset_end = voffset_range
+    with open(path_bam, "rb") as file_reader:
+        for _, read_data in generate_reads_from_virtual_offset(file_reader, voffset_start, voffset_end):
+            refID, pos = struct.unpack_from("<ii", read_data, 0)
+            merged_refID = list_refID_map[refID] if refID >= 0 else -1
+            if merged_refID_only != None and merged_refID != merged_refID_only:
+                if merged_refID_only == -1:
+                    continue
+                break
+            if not is_identity_map:
+                read_data = remap_refID_on_read_binary_data(read_data, list_refID_map)
+            yield (merged_refID if merged_refID >= 0 else _key_unmapped, pos), struct.pack("<I", len(read_data)) + read_data
+
+def merge_reads_of_sorted_bams(list_path_bams, list_voffset_ranges, list_refID_maps, path_save, merged_refID_only = None, n_threads = 4, compresslevel = 6):
+    # Heap-based merge of reads from each BAM, written without header and EOF. Returns the stats.
+    # Reads with the same (refID, pos) keep the order of list_path_bams.
+    time_start = perf_counter()
+    stats = new_stats()
+    writer = BgzfParallelWriter(path_save, n_threads, compresslevel, stats = stats)
+    list_generators = [
+        generate_sort_key_and_reads(path_bam, voffset_range, list_refID_map, merged_refID_only)
+        for path_bam, voffset_range, list_refID_map in zip(list_path_bams, list_voffset_ranges, list_refID_maps)
+        if voffset_range != None
+    ]
+    for _, read_data in heapq.merge(*list_generators, key = lambda key_and_read: key_and_read[0]):
+        writer.write_read(read_data)
+        stats["reads_emitted"] += 1
+    writer.close(add_eof = False)
+    stats["time_elapsed"] = perf_counter() - time_start
+    return stats
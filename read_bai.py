@@ -2,7 +2,7 @@
 import struct
 
 
-def read_bai(path_bai):
+def read_bai(path_bai, verbose = True):
     with open(path_bai, "rb") as handler:
         contents = handler.read()
     
@@ -62,12 +62,13 @@ def read_bai(path_bai):
         assert len(n_no_coor) == 8
         assert len((struct.unpack("<Q", contents[ind_now:ind_now+8]))) == 1
         n_no_coor = struct.unpack("<Q", contents[ind_now:ind_now+8])[0]
-        print("Unplaced unmapped reads: ", n_no_coor, sep = '')
+        if verbose:
+            print("Unplaced unmapped reads: ", n_no_coor, sep = '')
     return dict_bin_per_ref
 # %%
-dict_bai = read_bai("/BiO/Access/yoonsung/Research/Test_bam_parallelize/U10K-00751_L01_R1.trimmed_bismark_bt2_pe.deduplicated.sorted.bam.bai")
+if __name__ == "__main__":
+    dict_bai = read_bai("/BiO/Access/yoonsung/Research/Test_bam_parallelize/U10K-00751_L01_R1.trimmed_bismark_bt2_pe.deduplicated.sorted.bam.bai")
 
-from Bio import bgzf
-# %%
-file_handler = bgzf.BgzfReader("/BiO/Access/yoonsung/Research/Test_bam_parallelize/U10K-00751_L01_R1.trimmed_bismark_bt2_pe.deduplicated.sorted.bam")
+    from Bio import bgzf
+    file_handler = bgzf.BgzfReader("/BiO/Access/yoonsung/Research/Test_bam_parallelize/U10K-00751_L01_R1.trimmed_bismark_bt2_pe.deduplicated.sorted.bam")
 # %%
@@ -1,28 +1,52 @@
 #%%
 from pathlib import Path
-import os, sys, subprocess
-from collections import OrderedDict
+import os, sys, glob, subprocess
 from time import time
 
-from joblib import Parallel, delayed
-
 sys.path.append(str(Path(__file__).parents[0]))
 from bam_util import *
+from bgzf_block_cache import BgzfBlockCache
+from bam_stats import *
+from bam_checkpoint import *
 
 _bgzf_eof = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+_duplicate_modes = [None, "mark", "remove"]
 
 class BamPairSorter():
-    def __init__(self, path_file, parallel = 1):
+    def __init__(self, path_file, parallel = 1, progress_callback = None, progress_interval = 10, duplicate_mode = None, checkpoint_dir = None, checkpoint_interval = 300):
         self.path = path_file
         self.parallel = parallel
         
+        # Duplicate read pairs: Same refID, unclipped 5' positions and strands of both mates
+        #   None: Keep all read pairs
+        #   "mark": Set the duplicate flag (0x400) on both mates, except the pair with the highest sum of MAPQ (cleared on it, as Picard does)
+        #   "remove": Do not write the duplicates
+        assert duplicate_mode in _duplicate_modes, f"Duplicate mode must be one of {_duplicate_modes}"
+        self.duplicate_mode = duplicate_mode
+        
+        # Stats of each step: "scan", "sort" and "write" (see bam_stats)
+        # progress_callback is called with the stats of scanning step at most once every "progress_interval" seconds
+        self.stats = dict()
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        
+        # Checkpoints for resuming after a crash: the scanned offset with the read pairs found so far (spilled every "checkpoint_interval" seconds),
+        # and the finished parts of writing. A rerun with the same "checkpoint_dir" continues from them. Removed when the sorted BAM is saved.
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_store = None
+        
         self.file_handler = None
         
         self.__data_header = None
         self.__offset_after_header = None
         
         self.__dict_refID_to_readpair_pos_and_offset = dict()
+        self.__dict_refID_to_readpair_duplicate_key = dict()
         self.__list_readpair_offset_diffchr = list()
+        # Number of items already spilled to the checkpoint
+        self.__dict_refID_to_n_spilled = dict()
+        self.__n_spilled_diffchr = 0
         
         self.__dict_refID_to_sorted_readpair_offset = dict()
         
@@ -30,10 +54,14 @@ class BamPairSorter():
         self.__set_file_reader()
         print("Checking BAM Header...", flush = True)
         self.__skip_header()
+        if self.checkpoint_dir != None:
+            self.checkpoint_store = CheckpointStore(self.checkpoint_dir, self.path, {"duplicate_mode":self.duplicate_mode})
         print("Checking Read pair coordinates...", flush = True)
         self.__get_read_pair_block_position_and_coordinates()
         print("Sorting Read pairs...", flush = True)
+        time_start = perf_counter()
         self.__sort_readpairs_by_coordinate()
+        self.stats["sort"] = {"time_elapsed":perf_counter() - time_start}
         
     def __set_file_reader(self):
         # Open BGzipped BAM file
@@ -54,16 +82,35 @@ class BamPairSorter():
     def __get_read_pair_block_position_and_coordinates(self):
         self.file_handler.seek(self.__offset_after_header)
         
+        stats = new_stats()
+        self.stats["scan"] = stats
+        progress_reporter = ProgressReporter(self.progress_callback, self.progress_interval)
+        time_start = perf_counter()
+        
         bef_refid = None
         bef_coord = None
         bef_curroffset = None
         bef_blockcoffset = None
         bef_tlen = None
         bef_readname = None
-        while 1:
+        bef_read_data = None
+        
+        dict_scan_checkpoint = self.checkpoint_store.load("scan") if self.checkpoint_store != None else None
+        if dict_scan_checkpoint != None:
+            print(f"Resuming from offset {dict_scan_checkpoint['offset']} of checkpoint", flush = True)
+            self.__load_scan_segments(dict_scan_checkpoint["n_segments"])
+            self.file_handler.seek(dict_scan_checkpoint["offset"])
+            bef_refid, bef_coord, bef_curroffset, bef_blockcoffset, bef_tlen, bef_readname, bef_read_data = dict_scan_checkpoint["pending_read"]
+            for key in ["bytes_read", "blocks_inflated", "reads_emitted"]:
+                stats[key] = dict_scan_checkpoint["stats"][key]
+        n_segments = dict_scan_checkpoint["n_segments"] if dict_scan_checkpoint != None else 0
+        is_scan_done = dict_scan_checkpoint != None and dict_scan_checkpoint["is_done"]
+        time_last_checkpoint = perf_counter()
+        while not is_scan_done:
             curr_offset = self.file_handler.tell()
-            bsize, bdata = load_bgzf_block(self.file_handler)
+            bsize, bdata = load_bgzf_block(self.file_handler, stats = stats)
             if bdata:
+                time_parse_start = perf_counter()
                 list_reads, list_read_start_bytes = split_bgzf_block_into_reads(bdata, True)
                 
                 for read_data, start_bytes_in_bdata in zip(list_reads, list_read_start_bytes):
@@ -79,6 +126,7 @@ class BamPairSorter():
                         bef_blockcoffset = start_bytes_in_bdata
                         bef_tlen = tlen
                         bef_readname = readname
+                        bef_read_data = read_data
                     else:
                         is_samechr = bef_refid == refID
                         
@@ -91,46 +139,144 @@ class BamPairSorter():
                             self.__dict_refID_to_readpair_pos_and_offset[refID].append(
                                 [front_coord, bef_curroffset, bef_blockcoffset, curr_offset, start_bytes_in_bdata]
                             )
+                            if self.duplicate_mode != None:
+                                if self.__dict_refID_to_readpair_duplicate_key.get(refID) == None:
+                                    self.__dict_refID_to_readpair_duplicate_key[refID] = list()
+                                self.__dict_refID_to_readpair_duplicate_key[refID].append(
+                                    get_duplicate_key_of_read_pair(bef_read_data, read_data)
+                                )
                             assert bef_tlen+tlen == 0, "Read pair of bam file is not preserved"
                         else:
                             self.__list_readpair_offset_diffchr.append([bef_curroffset, bef_blockcoffset, curr_offset, start_bytes_in_bdata])
                         
                         bef_refid = None
+                time_parse_end = perf_counter()
+                stats["time_parse"] += time_parse_end - time_parse_start
+                stats["reads_emitted"] += len(list_reads)
+                stats["time_elapsed"] = time_parse_end - time_start
+                progress_reporter.report(stats)
+                if self.checkpoint_store != None and time_parse_end - time_last_checkpoint >= self.checkpoint_interval:
+                    pending_read = [bef_refid, bef_coord, bef_curroffset, bef_blockcoffset, bef_tlen, bef_readname, bef_read_data]
+                    n_segments = self.__save_scan_checkpoint(n_segments, pending_read, stats)
+                    time_last_checkpoint = perf_counter()
             else:
                 break
+        if self.checkpoint_store != None and not is_scan_done:
+            self.__save_scan_checkpoint(n_segments, [None] * 7, stats, is_done = True)
+        stats["time_elapsed"] = perf_counter() - time_start
+        stats.update(summarize_stats(stats))
+        progress_reporter.report(stats, force = True)
         assert bef_refid == None, "Process ended with leftover read"
         
+    def __save_scan_checkpoint(self, n_segments, pending_read, stats, is_done = False):
+        # Spill the read pairs found since the last checkpoint as a new segment, and then record the offset of the next block.
+        # If the process stops between them, the segment is ignored and the blocks are scanned again.
+        dict_segment = {
+            "pos_and_offset" : {refID: list_pairs[self.__dict_refID_to_n_spilled.get(refID, 0):] for refID, list_pairs in self.__dict_refID_to_readpair_pos_and_offset.items()},
+            "duplicate_key" : {refID: list_keys[self.__dict_refID_to_n_spilled.get(refID, 0):] for refID, list_keys in self.__dict_refID_to_readpair_duplicate_key.items()},
+            "diffchr" : self.__list_readpair_offset_diffchr[self.__n_spilled_diffchr:],
+        }
+        self.checkpoint_store.save(f"scan.segment{n_segments}", dict_segment)
+        self.checkpoint_store.save("scan", {
+            "offset" : self.file_handler.tell(),
+            "n_segments" : n_segments + 1,
+            "pending_read" : pending_read,
+            "stats" : dict(stats),
+            "is_done" : is_done,
+        })
+        self.__dict_refID_to_n_spilled = {refID: len(list_pairs) for refID, list_pairs in self.__dict_refID_to_readpair_pos_and_offset.items()}
+        self.__n_spilled_diffchr = len(self.__list_readpair_offset_diffchr)
+        return n_segments + 1
+    
+    def __load_scan_segments(self, n_segments):
+        for ind_segment in range(n_segments):
+            dict_segment = self.checkpoint_store.load(f"scan.segment{ind_segment}")
+            for refID, list_pairs in dict_segment["pos_and_offset"].items():
+                self.__dict_refID_to_readpair_pos_and_offset.setdefault(refID, list()).extend(list_pairs)
+            for refID, list_keys in dict_segment["duplicate_key"].items():
+                self.__dict_refID_to_readpair_duplicate_key.setdefault(refID, list()).extend(list_keys)
+            self.__list_readpair_offset_diffchr.extend(dict_segment["diffchr"])
+        self.__dict_refID_to_n_spilled = {refID: len(list_pairs) for refID, list_pairs in self.__dict_refID_to_readpair_pos_and_offset.items()}
+        self.__n_spilled_diffchr = len(self.__list_readpair_offset_diffchr)
+        
     def __sort_readpairs_by_coordinate(self):
+        n_readpairs = 0
+        n_duplicates = 0
         for refID in self.__dict_refID_to_readpair_pos_and_offset.keys():
             list_readpair_pos_and_offset = self.__dict_refID_to_readpair_pos_and_offset[refID]
+            n_readpairs += len(list_readpair_pos_and_offset)
+            if self.duplicate_mode != None:
+                is_duplicate = get_duplicate_mask_of_read_pairs(self.__dict_refID_to_readpair_duplicate_key[refID])
+                n_duplicates += int(is_duplicate.sum())
+                # The last item tells the writer to set or clear the duplicate flag of the pair
+                if self.duplicate_mode == "remove":
+                    list_readpair_pos_and_offset = [pair_info + [False] for pair_info, is_dup in zip(list_readpair_pos_and_offset, is_duplicate.tolist()) if not is_dup]
+                else:
+                    list_readpair_pos_and_offset = [pair_info + [is_dup] for pair_info, is_dup in zip(list_readpair_pos_and_offset, is_duplicate.tolist())]
             sorted_readpair_by_pos = sorted(list_readpair_pos_and_offset, key = lambda val: val[0])
             sorted_readpair_offsets = list(map(lambda pair_info: pair_info[1:], sorted_readpair_by_pos))
             self.__dict_refID_to_sorted_readpair_offset[refID] = sorted_readpair_offsets
+        if self.duplicate_mode != None:
+            self.stats["duplicate"] = {"mode":self.duplicate_mode, "n_readpairs":n_readpairs, "n_duplicates":n_duplicates}
             
     def save_sorted_reads(self, path_save, path_save_diffchr = None):
         print("Save sorted read pairs...")
+        # Without checkpoints, the temporary files are removed if writing fails.
+        # With checkpoints, they are kept and the finished parts are reused by the next run.
+        try:
+            list_time_check_results = self.__save_sorted_reads(path_save)
+        except BaseException:
+            if self.checkpoint_store == None:
+                [os.remove(path_tmp) for path_tmp in glob.glob(f"{glob.escape(path_save)}.__tmp.*")]
+            raise
+        if self.checkpoint_store != None:
+            self.checkpoint_store.clear()
+        return list_time_check_results
+    
+    def __save_sorted_reads(self, path_save):
+        time_start = perf_counter()
         path_save_header = f"{path_save}.__tmp.header"
         write_bam_header(path_save_header, self.__data_header)
         
         list_files_concat = [path_save_header]
+        list_time_check_results = list()
         for refID in sorted(self.__dict_refID_to_sorted_readpair_offset.keys()):
             list_readpairs_for_writing = self.__dict_refID_to_sorted_readpair_offset[refID]
             threads_for_ref = min(len(list_readpairs_for_writing), self.parallel)
+            path_save_refID = f"{path_save}.__tmp.refID{refID}"
+            list_files_concat.append(path_save_refID)
+            # Parts are checkpointed with the number of threads, because the split depends on it
+            key_prefix = f"write.refID{refID}.of{threads_for_ref}."
+            dict_concat_checkpoint = self.checkpoint_store.load(f"concat.refID{refID}") if self.checkpoint_store != None else None
+            if dict_concat_checkpoint != None and os.path.exists(path_save_refID):
+                list_time_check_results.extend(dict_concat_checkpoint["stats"])
+                [os.remove(path_tmp) for path_tmp in glob.glob(f"{glob.escape(path_save_refID)}.*")]
+                continue
+            
             list_splitted_readpairs_for_threads = self.__split_list_into_n_lists(list_readpairs_for_writing, threads_for_ref)
             list_temp_files_for_threads = list(map(lambda ind: f"{path_save}.__tmp.refID{refID}.{ind}", range(threads_for_ref)))
-            with Parallel(n_jobs = threads_for_ref) as parallel:
-                list_time_check_results = parallel(delayed(write_part_of_sorted_bam_with_offsets)(
-                    self.path,
-                    list_temp_files_for_threads[ind],
-                    list_splitted_readpairs_for_threads[ind]
-                )for ind in range(threads_for_ref))
-            path_save_refID = f"{path_save}.__tmp.refID{refID}"
-            subprocess.run(f"cat {' '.join(list_temp_files_for_threads)} > {path_save_refID}", shell = True)
+            if self.checkpoint_store != None:
+                # Parts written by the last run but missing now are written again
+                [self.checkpoint_store.remove(f"{key_prefix}{ind}") for ind in range(threads_for_ref) if not os.path.exists(list_temp_files_for_threads[ind])]
+            list_stats_of_ref = run_shards_with_checkpoint(
+                write_part_of_sorted_bam_with_offsets,
+                [(self.path, list_temp_files_for_threads[ind], list_splitted_readpairs_for_threads[ind]) for ind in range(threads_for_ref)],
+                self.checkpoint_store,
+                threads_for_ref,
+                key_prefix
+            )
+            list_time_check_results.extend(list_stats_of_ref)
+            concat_files_atomic(list_temp_files_for_threads, path_save_refID)
+            if self.checkpoint_store != None:
+                self.checkpoint_store.save(f"concat.refID{refID}", {"stats":list_stats_of_ref})
             [os.remove(path_tmp) for path_tmp in list_temp_files_for_threads]
-            list_files_concat.append(path_save_refID)
-        subprocess.run(f"cat {' '.join(list_files_concat)} > {path_save}", shell = True)
+        concat_files_atomic(list_files_concat, f"{path_save}.__tmp.concat")
+        write_eof(f"{path_save}.__tmp.concat")
+        os.replace(f"{path_save}.__tmp.concat", path_save)
         [os.remove(path_tmp) for path_tmp in list_files_concat]
-        write_eof(path_save)
+        # Stats of every writer (per refID and per thread)
+        # Threads of a refID run at the same time, but refIDs are written one after another, so the elapsed time is the wall time.
+        self.stats["write"] = set_time_elapsed(merge_stats(list_time_check_results), perf_counter() - time_start)
         return list_time_check_results
         
     def __split_list_into_n_lists(self, data, n_split):
@@ -153,6 +299,12 @@ class BamPairSorter():
     def __del__(self):
         self.close_reader()
         
+def concat_files_atomic(list_files_concat, path_save):
+    # Concatenate into a temporary file and rename it, so that "path_save" exists only if it is complete
+    path_tmp = f"{path_save}.__tmp.partial"
+    subprocess.run(f"cat {' '.join(list_files_concat)} > {path_tmp}", shell = True, check = True)
+    os.replace(path_tmp, path_save)
+
 def get_readname_on_read_binary_data(data):
     byte_start_l_read_name = 8    
     byte_start_read_name = 32
@@ -180,43 +332,100 @@ def get_pos_on_read_binary_data(data):
     
     return pos
 
-def write_part_of_sorted_bam_with_offsets(path_bam, path_save, list_read_offsets):    
+def get_unclipped_5prime_on_read_binary_data(data):
+    # 5' end of the read on the reference, including the clipped bases (same as Picard MarkDuplicates)
+    pos, l_read_name, n_cigar_op, flag = struct.unpack_from("<iB3xHH", data, 4)
+    list_cigar = struct.unpack_from(f"<{n_cigar_op}I", data, 32 + l_read_name)
+    if flag & 0x10 == 0:
+        clip_5prime = 0
+        for cigar_op in list_cigar:
+            if (cigar_op & 0xf) not in (4, 5): # S, H
+                break
+            clip_5prime += cigar_op >> 4
+        return pos - clip_5prime
+    ref_len = 0
+    clip_5prime = 0
+    for cigar_op in list_cigar:
+        if (cigar_op & 0xf) in (0, 2, 3, 7, 8): # M, D, N, =, X
+            ref_len += cigar_op >> 4
+            clip_5prime = 0
+        elif (cigar_op & 0xf) in (4, 5):
+            clip_5prime += cigar_op >> 4
+    return pos + max(ref_len, 1) - 1 + clip_5prime
+
+def get_duplicate_key_of_read_pair(read1_data, read2_data):
+    # [5' of mate A, strand of mate A, 5' of mate B, strand of mate B, score]
+    # Mates are ordered by (5', strand), so the key does not depend on which mate comes first
+    list_mate_keys = sorted([
+        (get_unclipped_5prime_on_read_binary_data(read_data), struct.unpack_from("<H", read_data, 14)[0] & 0x10 != 0)
+        for read_data in [read1_data, read2_data]
+    ])
+    score = read1_data[9] + read2_data[9] # Sum of MAPQ
+    return [list_mate_keys[0][0], int(list_mate_keys[0][1]), list_mate_keys[1][0], int(list_mate_keys[1][1]), score]
+
+def get_duplicate_mask_of_read_pairs(list_duplicate_keys):
+    # True for every pair except the best one (highest score, then earliest in file) among the pairs with the same key
+    arr_keys = np.array(list_duplicate_keys, dtype = np.int64).reshape(-1, 5)
+    # lexsort: The last key is the primary key. Pairs with higher score come first within the same key.
+    ind_sorted = np.lexsort((-arr_keys[:, 4], arr_keys[:, 3], arr_keys[:, 2], arr_keys[:, 1], arr_keys[:, 0]))
+    _, ind_first = np.unique(arr_keys[ind_sorted, :4], axis = 0, return_index = True)
+    is_duplicate = np.ones(len(arr_keys), dtype = bool)
+    is_duplicate[ind_sorted[ind_first]] = False
+    return is_duplicate
+
+def mark_duplicate_on_read_binary_data(data, is_duplicate = True):
+    # data: Read data including the leading "block_size" (get_single_read_data_from_block_data)
+    # Set the duplicate flag (0x400), or clear it if not is_duplicate, so that the flag of input does not remain
+    byte_start_flag = 4 + 14
+    flag = struct.unpack_from("<H", data, byte_start_flag)[0]
+    flag_new = flag | 0x400 if is_duplicate else flag & ~0x400
+    if flag_new == flag:
+        return data
+    return data[:byte_start_flag] + struct.pack("<H", flag_new) + data[byte_start_flag+2:]
+
+def write_part_of_sorted_bam_with_offsets(path_bam, path_save, list_read_offsets, cache_max_bytes = 64 * 1024 * 1024):    
+    # Returns the stats of this writer (see bam_stats)
+    time_start = perf_counter()
+    stats = new_stats()
     file_reader = open(path_bam, "rb")
     file_writer = open(path_save, "wb")
     
-    cache = OrderedDict()
+    cache = BgzfBlockCache(cache_max_bytes)
     buffer = b''
     
-    def read_block_data_from_offset_cached(file_reader, offset, maxcache = 1000):
-        if offset in cache:
-            cache.move_to_end(offset)
-            return cache[offset]
-        elif len(cache) == maxcache:
-            cache.popitem(last = False)
-        cache[offset] = read_block_data_from_offset(file_reader, offset, ignore_checking = True)
-        return cache[offset]
-    
     for pair_offsets in list_read_offsets:
-        read1_offset, read1_startbytes, read2_offset, read2_startbytes = pair_offsets
-        read1_block_data = read_block_data_from_offset_cached(file_reader, read1_offset)
+        # Optional 5th item: Whether the pair is duplicate. The duplicate flag is set or cleared accordingly.
+        read1_offset, read1_startbytes, read2_offset, read2_startbytes = pair_offsets[:4]
+        read1_block_data = read_block_data_from_offset(file_reader, read1_offset, ignore_checking = True, cache = cache, stats = stats)
         read1_data = get_single_read_data_from_block_data(read1_block_data, read1_startbytes)
         
-        read2_block_data = read_block_data_from_offset_cached(file_reader, read2_offset)
+        read2_block_data = read_block_data_from_offset(file_reader, read2_offset, ignore_checking = True, cache = cache, stats = stats)
         read2_data = get_single_read_data_from_block_data(read2_block_data, read2_startbytes)
         
+        if len(pair_offsets) > 4:
+            read1_data = mark_duplicate_on_read_binary_data(read1_data, pair_offsets[4])
+            read2_data = mark_duplicate_on_read_binary_data(read2_data, pair_offsets[4])
+        
         readpair_data = read1_data+read2_data
         if len(buffer) + len(readpair_data) >= 65536:
-            write_block(file_writer, buffer)
+            write_block(file_writer, buffer, stats = stats)
             buffer = readpair_data
         else:
             buffer += readpair_data
         
     if len(buffer) > 0:
-        write_block(file_writer, buffer)
+        write_block(file_writer, buffer, stats = stats)
     
     file_reader.close()
+    time_write_start = perf_counter()
     file_writer.flush()
     file_writer.close()
+    stats["time_write"] += perf_counter() - time_write_start
+    
+    stats["reads_emitted"] = 2 * len(list_read_offsets)
+    add_cache_stats(stats, cache.get_cache_stats())
+    stats["time_elapsed"] = perf_counter() - time_start
+    return stats
 
 #%%
 if __name__ == "__main__":